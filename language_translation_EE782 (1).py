@@ -15,14 +15,22 @@ import math
 
 ## coding our own LAYER NORMALISZATION CODE as the inbuilt one doesnt allow bias = false
 class LayerNormalization(nn.Module):
-    def __init__(self, eps:float = 10**-6)-> None:
+    def __init__(self, eps:float = 10**-6, fused:bool = False)-> None:
         super().__init__()
         self.eps = eps
+        self.fused = fused
         self.alpha = nn.Parameter(torch.ones(1))
         self.bias = nn.Parameter(torch.zeros(1))    ## alpha and beta are learnable parameters
 
     def forward(self, x):
         # x: [batch, seq_length , hidden_size]
+        if self.fused:
+            ## same maths in fewer passes: mean and (unbiased) variance come from one var_mean reduction and
+            ## alpha * (x - mean) / (std + eps) + bias == x * scale + (bias - mean * scale) with scale = alpha / (std + eps),
+            ## so the only full size tensor created is the output (scale and shift are [batch, seq, 1])
+            var, mean = torch.var_mean(x, dim = -1, keepdim = True)
+            scale = self.alpha / (var.sqrt() + self.eps)
+            return torch.addcmul(self.bias - mean * scale, x, scale)
         mean = x.mean(-1, keepdim = True) # [batch, seq, 1]
         std = x.std(-1, keepdim = True) # [batch , seq , 1]
         #keep the dimension for broadcasting , if (keepdim = False) - the last dimension will not be there - [batch , seqdim]
@@ -76,36 +84,81 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe' , pe) ## saves the value of pe as "pe" even if the kernel gets closed, and this is not back_propagated
 
 
-    def forward(self, x):
-        x = x + (self.pe[:, : x.shape[1] , :]).requires_grad_(False) # [batch, seq_len , d_model]
+    def forward(self, x, start_pos:int = 0):
+        # start_pos is the position of the first token of x, non zero only when decoding incrementally one token at a time
+        # it can also be a [batch] tensor when every row is at its own position (continuous batching, ContinuousBatchScheduler)
+        if torch.is_tensor(start_pos):
+            positions = start_pos.unsqueeze(-1) + torch.arange(x.shape[-2], device = x.device) # [batch, seq_len]
+            return self.dropout(x + self.pe[0, positions].requires_grad_(False))
+        x = x + (self.pe[:, start_pos : start_pos + x.shape[-2] , :]).requires_grad_(False) # [batch, seq_len , d_model]
         # x = x + (self.pe[:, : , :]).requires_grad_(False)
-        # x.shape[1] gives the seq_length of a sentence.
+        # x.shape[-2] gives the seq_length of a sentence (x can have an extra beam dimension, [batch, beam, seq_len, d_model])
         return self.dropout(x)
 
 
 class ResidualConnection(nn.Module):
-    def __init__(self, dropout:float)-> None:
+    def __init__(self, dropout:float, fused:bool = False)-> None:
         super().__init__()
+        self.fused = fused
         self.dropout = nn.Dropout(dropout)
-        self.norm = LayerNormalization()
+        self.norm = LayerNormalization(fused = fused)
 
     def forward(self, x, sublayer):
+        if self.fused:
+            ## the sublayer output is a fresh tensor (output of w_o / linear_2) that backward does not need, so x is added into it in place
+            ## only when the dtypes match: under bf16/fp16 autocast the output is half precision and adding in place would downcast the residual stream
+            out = self.dropout(sublayer(self.norm(x)))
+            return out.add_(x) if out.dtype == x.dtype else x + out
         return x + self.dropout(sublayer(self.norm(x))) ## cant understand it currently
 
 
+## lower triangular [size, size] bool masks, built once per size and device and reused by every attention call
+_causal_mask_cache = {}
+
+def cached_causal_mask(size:int, device):
+    ## while tracing for export the size is symbolic, so the mask is built in the graph instead of being frozen from the cache
+    if torch.jit.is_tracing():
+        return torch.ones(size, size, dtype = torch.bool, device = device).tril()
+    key = (size, str(device))
+    if key not in _causal_mask_cache:
+        _causal_mask_cache[key] = torch.ones(size, size, dtype = torch.bool, device = device).tril()
+    return _causal_mask_cache[key]
+
+
 ## MULTI HEAD ATTENTION part which we can use for BOTH ENCODER and DECODER
 class MultiHeadAttentionBlock(nn.Module):
-    def __init__(self, d_model:int, h:int, dropout:float)-> None:
+    ## "math" - explicit softmax(QK^T/sqrt(d_k))V, the only backend that keeps the attention probabilities for visualisation
+    ## "sdpa" - torch.nn.functional.scaled_dot_product_attention (fused kernel)
+    ## "chunked" - processes chunk_size queries at a time so the full [batch, h, seq, seq] score matrix is never held in memory
+    ATTENTION_BACKENDS = ("math", "sdpa", "chunked")
+
+    ## fused = None - separate w_q, w_k, w_v
+    ## fused = "qkv" - one packed [3 * d_model, d_model] projection w_qkv, one GEMM when q, k and v are the same tensor (self attention)
+    ## fused = "kv" - w_q plus one packed [2 * d_model, d_model] projection w_kv for key and value (cross attention)
+    ## checkpoints with separate w_q/w_k/w_v weights are packed on load, see _load_from_state_dict
+    def __init__(self, d_model:int, h:int, dropout:float, attention_backend:str = "math", chunk_size:int = 64, fused:str = None)-> None:
         super().__init__()
         self.d_model = d_model # embedding vector size
         self.h = h # Number of heads
         #make sure d_model is divisible by h
         assert d_model % h == 0, "d_model is not divisible by h"
+        assert attention_backend in self.ATTENTION_BACKENDS, f"unknown attention backend {attention_backend}"
+        self.attention_backend = attention_backend
+        self.chunk_size = chunk_size
+        self.attention_scores = None
 
         self.d_k = d_model // h # dimension of embedding seen by each head
-        self.w_q = nn.Linear(d_model, d_model, bias = False) #Wq
-        self.w_k = nn.Linear(d_model, d_model, bias = False) #Wk
-        self.w_v = nn.Linear(d_model, d_model, bias = False) #Wv
+        assert fused in (None, "qkv", "kv"), f"unknown fused projection {fused}"
+        self.fused = fused
+        if fused == "qkv":
+            self.w_qkv = nn.Linear(d_model, 3 * d_model, bias = False) #[Wq; Wk; Wv]
+        else:
+            self.w_q = nn.Linear(d_model, d_model, bias = False) #Wq
+            if fused == "kv":
+                self.w_kv = nn.Linear(d_model, 2 * d_model, bias = False) #[Wk; Wv]
+            else:
+                self.w_k = nn.Linear(d_model, d_model, bias = False) #Wk
+                self.w_v = nn.Linear(d_model, d_model, bias = False) #Wv
         self.w_o = nn.Linear(d_model, d_model, bias = False) #Wo
         ## Heads are not considered yet in the above code
         self.dropout = nn.Dropout(dropout)
@@ -126,23 +179,137 @@ class MultiHeadAttentionBlock(nn.Module):
         # return attention scores which can be used for visualisation
         return (attention_scores @ value) , attention_scores
 
-    def forward(self, q, k , v , mask):
-        query = self.w_q(q) ## [batch, seq_length, d_model] -> [batch, seq_length, d_model]
-        key = self.w_k(k) # [batch, seq_length, d_model] -> [batch, seq_length, d_model]
-        value = self.w_v(v) # [batch, seq_length, d_model] -> [batch, seq_length, d_model]
-
-        # dividing it into h heads
+    @staticmethod
+    def sdpa_attention(query, key, value, mask, dropout:nn.Dropout):
+        ## same maths as attention() in one fused call, the probabilities are not returned
+        if mask is not None:
+            mask = mask != 0 # True where attention is allowed
+        dropout_p = dropout.p if (dropout is not None and dropout.training) else 0.0
+        return nn.functional.scaled_dot_product_attention(query, key, value, attn_mask = mask, dropout_p = dropout_p)
+
+    @staticmethod
+    def chunked_attention(query, key, value, mask, dropout:nn.Dropout, chunk_size:int = 64):
+        ## memory efficient attention: only a [batch, h, chunk_size, seq_length] block of scores exists at any time
+        d_k = query.shape[-1]
+        outputs = []
+        for start in range(0, query.shape[-2], chunk_size):
+            end = start + chunk_size
+            attention_scores = (query[..., start:end, :] @ key.transpose(-2,-1)) / math.sqrt(d_k)
+            if mask is not None:
+                ## padding masks have a single query row which broadcasts, causal masks are sliced with the queries
+                chunk_mask = mask if mask.shape[-2] == 1 else mask[..., start:end, :]
+                attention_scores.masked_fill_(chunk_mask == 0, -1e4)
+            attention_scores = attention_scores.softmax(dim = -1)
+            if dropout is not None:
+                attention_scores = dropout(attention_scores)
+            outputs.append(attention_scores @ value)
+        return torch.cat(outputs, dim = -2)
+
+    @staticmethod
+    def build_mask(mask, key_lengths, is_causal:bool, query, key):
+        ## alternative to the dense masks: key_lengths [batch] (or [batch, beam]) is the number of non padding keys of every row,
+        ## it is compared against the key positions by broadcasting, giving a [batch, 1, 1, key_len] mask
+        ## is_causal adds the cached lower triangular mask, the queries are the LAST query_len positions (query_len == 1 with a cache)
+        query_len, key_len = query.shape[-2], key.shape[-2]
+        if key_lengths is not None:
+            ## [batch] -> [batch, 1, 1, 1] for [batch, h, query_len, key_len] scores, [batch, beam] -> [batch, beam, 1, 1, 1] with a beam dimension
+            lengths = key_lengths.view(*key_lengths.shape, *([1] * (query.dim() - key_lengths.dim())))
+            padding = torch.arange(key_len, device = key.device) < lengths
+            mask = padding if mask is None else (mask != 0) & padding
+        if is_causal:
+            causal = cached_causal_mask(key_len, key.device)[key_len - query_len :]
+            mask = causal if mask is None else (mask != 0) & causal
+        return mask
+
+    def split_heads(self, x):
         #[batch, seq_length, d_model] -> [batch, seq_length, h, d_k] -> [batch, h, seq_length, d_k]
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1,2) # query.shape[1] = seq_length(), query.shape[0] = batch
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1,2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1,2)
+        # leading dimensions are kept as they are, so [batch, beam, seq_length, d_model] -> [batch, beam, h, seq_length, d_k] also works
+        return x.view(*x.shape[:-1], self.h, self.d_k).transpose(-3,-2)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        ## pack the separate projections of an unfused checkpoint into w_qkv / w_kv
+        if self.fused == "qkv" and prefix + "w_q.weight" in state_dict:
+            state_dict[prefix + "w_qkv.weight"] = torch.cat([state_dict.pop(prefix + f"w_{n}.weight") for n in "qkv"], dim = 0)
+        if self.fused == "kv" and prefix + "w_k.weight" in state_dict:
+            state_dict[prefix + "w_kv.weight"] = torch.cat([state_dict.pop(prefix + f"w_{n}.weight") for n in "kv"], dim = 0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_qkv(self, q, k, v, project_kv:bool = True):
+        ## [batch, seq_length, d_model] -> query, key, value each [batch, seq_length, d_model] (key, value are None if not project_kv)
+        if self.fused == "qkv":
+            if project_kv and q is k and k is v:
+                return self.w_qkv(q).chunk(3, dim = -1)
+            ## different inputs, use the matching rows of the packed weight
+            w_q, w_k, w_v = self.w_qkv.weight.chunk(3, dim = 0)
+            if not project_kv:
+                return nn.functional.linear(q, w_q), None, None
+            return nn.functional.linear(q, w_q), nn.functional.linear(k, w_k), nn.functional.linear(v, w_v)
+
+        query = self.w_q(q)
+        if not project_kv:
+            return query, None, None
+        if self.fused == "kv":
+            if k is v:
+                key, value = self.w_kv(k).chunk(2, dim = -1)
+                return query, key, value
+            w_k, w_v = self.w_kv.weight.chunk(2, dim = 0)
+            return query, nn.functional.linear(k, w_k), nn.functional.linear(v, w_v)
+        return query, self.w_k(k), self.w_v(v)
+
+    def project_kv(self, x):
+        ## keys and values of x split into heads, [batch, seq_length, d_model] -> 2 x [batch, h, seq_length, d_k]
+        ## used to fill the cross attention cache of newly admitted rows (ContinuousBatchScheduler)
+        if self.fused == "qkv":
+            _, w_k, w_v = self.w_qkv.weight.chunk(3, dim = 0)
+            key, value = nn.functional.linear(x, w_k), nn.functional.linear(x, w_v)
+        elif self.fused == "kv":
+            key, value = self.w_kv(x).chunk(2, dim = -1)
+        else:
+            key, value = self.w_k(x), self.w_v(x)
+        return self.split_heads(key), self.split_heads(value)
+
+    def forward(self, q, k , v , mask, cache = None, static_kv:bool = False, key_lengths = None, is_causal:bool = False):
+        ## cache - dict holding the already projected "key" and "value" of this attention at one layer position, only used for incremental decoding
+        ## static_kv = True for cross attention: k and v (encoder output) never change, so they are projected once and reused at every step
+        ## static_kv = False for self attention: only the newest token is projected and appended to the cached keys and values
+        reuse_kv = cache is not None and static_kv and "key" in cache
+        query, key, value = self.project_qkv(q, k, v, project_kv = not reuse_kv)
+        query = self.split_heads(query) ## [batch, seq_length, d_model] -> [batch, h, seq_length, d_k]
+
+        if reuse_kv:
+            key, value = cache["key"], cache["value"]
+        else:
+            key = self.split_heads(key) # [batch, seq_length, d_model] -> [batch, h, seq_length, d_k]
+            value = self.split_heads(value) # [batch, seq_length, d_model] -> [batch, h, seq_length, d_k]
+            if cache is not None and "positions" in cache:
+                ## slot cache (ContinuousBatchScheduler): preallocated [batch, h, max_len, d_k] buffers, every row writes its
+                ## newest key/value at its own position, the caller masks the keys after it with key_lengths = positions + 1
+                rows = torch.arange(key.shape[0], device = key.device)
+                cache["key"][rows, :, cache["positions"]] = key[..., -1, :]
+                cache["value"][rows, :, cache["positions"]] = value[..., -1, :]
+                key, value = cache["key"], cache["value"]
+            elif cache is not None:
+                if not static_kv and "key" in cache:
+                    key = torch.cat([cache["key"], key], dim = -2)
+                    value = torch.cat([cache["value"], value], dim = -2)
+                cache["key"], cache["value"] = key, value
+
+        ## masks from lengths / causal flag, see build_mask
+        if key_lengths is not None or is_causal:
+            mask = MultiHeadAttentionBlock.build_mask(mask, key_lengths, is_causal, query, key)
 
         #calculate attention
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if self.attention_backend == "sdpa":
+            x = MultiHeadAttentionBlock.sdpa_attention(query, key, value, mask, self.dropout)
+        elif self.attention_backend == "chunked":
+            x = MultiHeadAttentionBlock.chunked_attention(query, key, value, mask, self.dropout, self.chunk_size)
+        else:
+            x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
 
         #combine all heads together
         # (batch, h, seq_length, d_k) -> (batch, seq_length, h , d_k) - > (batch , seq_length, d_model)
-        x = x.transpose(1,2).contiguous().view(x.shape[0] , -1, self.h * self.d_k)
+        x = x.transpose(-3,-2).contiguous()
+        x = x.view(*x.shape[:-2], self.h * self.d_k)
 
         # multipply by wo
         # (batch , seq_length, d_model) -> (batch , seq_length, d_model)
@@ -150,14 +317,14 @@ class MultiHeadAttentionBlock(nn.Module):
 
 ## a single encoder block
 class EncoderBlock(nn.Module):
-    def __init__(self, self_attention_block:MultiHeadAttentionBlock, feed_forward_block:FeedForwardBlock , dropout:float)-> None:
+    def __init__(self, self_attention_block:MultiHeadAttentionBlock, feed_forward_block:FeedForwardBlock , dropout:float, fused_norm:bool = False)-> None:
         super().__init__()
         self.self_attention_block = self_attention_block
         self.feed_forward_block = feed_forward_block
-        self.residual_connection = nn.ModuleList([ResidualConnection(dropout) for _ in range(2)])
+        self.residual_connection = nn.ModuleList([ResidualConnection(dropout, fused_norm) for _ in range(2)])
 
-    def forward(self, x, src_mask):
-        x = self.residual_connection[0](x, lambda x: self.self_attention_block(x,x,x, src_mask))
+    def forward(self, x, src_mask, src_lengths = None):
+        x = self.residual_connection[0](x, lambda x: self.self_attention_block(x,x,x, src_mask, key_lengths = src_lengths))
         ## as for an encoder key, query, value have same inputs
         x = self.residual_connection[1](x, self.feed_forward_block)
         # in encoder block, one can see 2 skip connections, one before and after the MHA and one before after the Feed forward layer.
@@ -165,43 +332,71 @@ class EncoderBlock(nn.Module):
 
 ## Actual encoder
 class Encoder(nn.Module):
-    def __init__(self, layers: nn.ModuleList) -> None:
+    def __init__(self, layers: nn.ModuleList, fused_norm:bool = False) -> None:
         super().__init__()
         self.layers = layers
-        self.norm = LayerNormalization()
-
-    def forward(self, x, mask):
-        for layer in self.layers:
-            x = layer(x, mask)
+        self.norm = LayerNormalization(fused = fused_norm)
+        ## layer POSITIONS whose activations are recomputed in backward instead of stored (see set_activation_checkpointing)
+        ## positions and not modules, so with the mirrored blocks e1 can be checkpointed at position 0 but not at position 5
+        self.checkpoint_layers = set()
+
+    def forward(self, x, mask, lengths = None):
+        for i, layer in enumerate(self.layers):
+            if i in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                x = torch.utils.checkpoint.checkpoint(layer, x, mask, lengths, use_reentrant = False)
+            else:
+                x = layer(x, mask, lengths)
         return self.norm(x)
 
 
 class DecoderBlock(nn.Module):
-    def __init__(self, self_attention_block:MultiHeadAttentionBlock, cross_attention_block : MultiHeadAttentionBlock, feed_forward_block:FeedForwardBlock, dropout:float) -> None:
+    def __init__(self, self_attention_block:MultiHeadAttentionBlock, cross_attention_block : MultiHeadAttentionBlock, feed_forward_block:FeedForwardBlock, dropout:float, fused_norm:bool = False) -> None:
         super().__init__()
         self.self_attention_block = self_attention_block
         self.cross_attention_block = cross_attention_block
         self.feed_forward_block = feed_forward_block
-        self.residual_connection = nn.ModuleList([ResidualConnection(dropout) for _ in range(3)])
+        self.residual_connection = nn.ModuleList([ResidualConnection(dropout, fused_norm) for _ in range(3)])
 
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        x = self.residual_connection[0](x, lambda x: self.self_attention_block(x ,x, x, tgt_mask))
+    def forward(self, x, encoder_output, src_mask, tgt_mask, layer_cache = None, src_lengths = None, tgt_lengths = None, is_causal:bool = False):
+        ## layer_cache = {"self": {...}, "cross": {...}} for this layer position when decoding incrementally, else None
+        self_cache = layer_cache["self"] if layer_cache is not None else None
+        cross_cache = layer_cache["cross"] if layer_cache is not None else None
+        x = self.residual_connection[0](x, lambda x: self.self_attention_block(x ,x, x, tgt_mask, self_cache, key_lengths = tgt_lengths, is_causal = is_causal))
         # initial masked multi head attention layer where encoder outputs are not used
-        x = self.residual_connection[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
+        x = self.residual_connection[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask, cross_cache, static_kv = True, key_lengths = src_lengths))
         # cross attention layers where query is x, and key and value are from encoder blocks
         x = self.residual_connection[2](x, self.feed_forward_block)
         return x
         # final feed forward layer
 
 class Decoder(nn.Module):
-    def __init__(self, layers : nn.ModuleList)-> None:
+    def __init__(self, layers : nn.ModuleList, fused_norm:bool = False)-> None:
         super().__init__()
         self.layers = layers
-        self.norm = LayerNormalization()
-
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layers in self.layers:
-            x = layers( x, encoder_output, src_mask, tgt_mask)
+        self.norm = LayerNormalization(fused = fused_norm)
+        self.checkpoint_layers = set() # same as Encoder.checkpoint_layers
+
+    def init_cache(self):
+        ## one cache entry per layer POSITION, not per module - build_transformer reuses the same block at
+        ## two positions (d1, d2, d3, d3, d2, d1) and each position sees different inputs, so they need their own keys/values
+        return [{"self": {}, "cross": {}} for _ in range(len(self.layers))]
+
+    @staticmethod
+    def cache_length(cache):
+        ## number of target tokens already stored in the cache, a [batch] tensor for a slot cache (every row at its own position)
+        if cache is None or "key" not in cache[0]["self"]:
+            return 0
+        if "positions" in cache[0]["self"]:
+            return cache[0]["self"]["positions"]
+        return cache[0]["self"]["key"].shape[-2]
+
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache = None, src_lengths = None, tgt_lengths = None, is_causal:bool = False):
+        for i, layers in enumerate(self.layers):
+            ## never while decoding with a cache, the cache dicts are filled as a side effect of the forward pass
+            if i in self.checkpoint_layers and cache is None and self.training and torch.is_grad_enabled():
+                x = torch.utils.checkpoint.checkpoint(layers, x, encoder_output, src_mask, tgt_mask, None, src_lengths, tgt_lengths, is_causal, use_reentrant = False)
+            else:
+                x = layers( x, encoder_output, src_mask, tgt_mask, cache[i] if cache is not None else None, src_lengths, tgt_lengths, is_causal)
         return self.norm(x)
 
 
@@ -215,6 +410,26 @@ class ProjectionLayer(nn.Module):
         # [batch, seq_length, d_model] -> [batch, seq_length, vocab_size]
         return torch.log_softmax(self.proj(x), dim = -1)
 
+    ## decoding only needs the argmax / top k, which log_softmax does not change, so these skip the normalisation
+    def gather_candidates(self, candidates):
+        ## candidates [batch, C] - target ids of a per sentence vocabulary shortlist, returns their rows of the projection:
+        ## weight [batch, C, d_model] and bias [batch, C]. Done once per batch, not at every decoding step
+        weight, bias = self.proj.weight, self.proj.bias
+        if callable(weight): # dynamically quantized linear (quantize_for_cpu) keeps its weight packed
+            weight, bias = weight().dequantize(), bias()
+        return weight[candidates], bias[candidates]
+
+    def logits(self, x, candidate_weights = None):
+        ## candidate_weights (gather_candidates) - only the shortlisted rows of proj.weight are multiplied
+        ## returns [..., vocab_size] or, with candidate_weights, [batch, ..., C] where position j is the logit of candidates[:, j]
+        if candidate_weights is None:
+            return self.proj(x)
+        weight, bias = candidate_weights
+        shape = x.shape
+        x = x.reshape(shape[0], -1, shape[-1]) # [batch, rows, d_model]
+        out = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2)) # [batch, rows, C]
+        return out.view(*shape[:-1], -1)
+
 
 class Transformer(nn.Module):
     def __init__(self, encoder: Encoder, decoder: Decoder, src_embed : InputEmbeddings, tgt_embed : InputEmbeddings, src_pos : PositionalEncoding, tgt_pos : PositionalEncoding, projection_layer : ProjectionLayer  )-> None:
@@ -227,26 +442,71 @@ class Transformer(nn.Module):
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
 
-    def encode(self, src, src_mask):
+    ## masks can be given either densely (src_mask [B, 1, 1, S], tgt_mask [B, 1, S, S]) or as lengths:
+    ## src_lengths / tgt_lengths [B] hold the number of non padding tokens and is_causal = True applies the causal mask,
+    ## those are turned into masks inside attention by broadcasting, nothing of size [B, 1, S, S] has to be built or moved
+    def encode(self, src, src_mask = None, src_lengths = None):
         #[batch, seq_length, d_model]
         src = self.src_embed(src)
         src = self.src_pos(src)
-        encoder_output = self.encoder(src, src_mask)
+        encoder_output = self.encoder(src, src_mask, src_lengths)
         return encoder_output
 
-    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor )-> None:
+    def init_decode_cache(self):
+        return self.decoder.init_cache()
+
+    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor = None, cache = None, src_lengths = None, tgt_lengths = None, is_causal:bool = False)-> None:
+        ## with cache (from init_decode_cache) pass only the NEW target tokens in tgt, the previous ones are read from the cache
+        ## the newest token may attend to every cached token, so tgt_mask can be None in that mode
         # [batch, seq_length, d_model]
         tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
+        tgt = self.tgt_pos(tgt, Decoder.cache_length(cache))
         # target - the thing we need to predict
-        decoder_output = self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        decoder_output = self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache, src_lengths, tgt_lengths, is_causal)
         return decoder_output
 
     def project(self, x):
         # [batch, seq_length, vocab_size]
         return self.projection_layer(x)
 
-def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_length: int, tgt_seq_length: int, d_model: int = 512, N:int=6, h:int=8, dropout:float = 0.1, d_ff:int=256):
+    def forward(self, src, tgt, src_lengths, tgt_lengths):
+        ## the full training forward pass (encode, causal decode, project) from the padded inputs and their lengths
+        encoder_output = self.encode(src, src_lengths = src_lengths)
+        decoder_output = self.decode(encoder_output, None, tgt, src_lengths = src_lengths, tgt_lengths = tgt_lengths, is_causal = True)
+        return self.project(decoder_output)
+
+    def project_logits(self, x, candidate_weights = None):
+        # unnormalised scores, [batch, seq_length, vocab_size] or over a shortlist [batch, seq_length, C]
+        return self.projection_layer.logits(x, candidate_weights)
+
+    def gather_candidates(self, candidates):
+        # projection rows of the shortlist candidates [batch, C], for project_logits
+        return self.projection_layer.gather_candidates(candidates)
+
+def sharing_schedule(schedule, N:int, num_unique:int = None):
+    ## maps every one of the N layer positions to the index of the unique block used there
+    ## "none"     - every position has its own block                      N=6 -> [0, 1, 2, 3, 4, 5]
+    ## "mirrored" - position i and N - 1 - i share a block                N=6 -> [0, 1, 2, 2, 1, 0]
+    ## "cyclic"   - num_unique blocks (default N // 2) repeated in order  N=6 -> [0, 1, 2, 0, 1, 2]
+    ## a list of ints is used as it is, e.g. [0, 0, 1, 1, 2, 2]
+    if isinstance(schedule, (list, tuple)):
+        indices = list(schedule)
+        assert len(indices) == N, f"sharing schedule has {len(indices)} entries for {N} layers"
+    elif schedule == "none":
+        indices = list(range(N))
+    elif schedule == "mirrored":
+        indices = [min(i, N - 1 - i) for i in range(N)]
+    elif schedule == "cyclic":
+        num_unique = num_unique or max(1, N // 2)
+        indices = [i % num_unique for i in range(N)]
+    else:
+        raise ValueError(f"unknown sharing schedule {schedule}")
+    assert sorted(set(indices)) == list(range(len(set(indices)))), "block indices must be 0, 1, ..., num_unique - 1"
+    return indices
+
+
+def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_length: int, tgt_seq_length: int, d_model: int = 512, N:int=6, h:int=8, dropout:float = 0.1, d_ff:int=256, attention_backend:str = "math",
+                      encoder_sharing = "mirrored", decoder_sharing = "mirrored", num_unique_blocks:int = None, fused_qkv:bool = False, fused_norm:bool = False):
     # create embedding layer
 
     src_embed = InputEmbeddings(d_model, src_vocab_size)
@@ -256,35 +516,37 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_length:
     src_pos = PositionalEncoding(d_model, src_seq_length, dropout)
     tgt_pos = PositionalEncoding(d_model, tgt_seq_length, dropout)
 
+    ## which unique block sits at which layer position, see sharing_schedule
+    encoder_schedule = sharing_schedule(encoder_sharing, N, num_unique_blocks)
+    decoder_schedule = sharing_schedule(decoder_sharing, N, num_unique_blocks)
+
     # create encoder blocks
     encoder_blocks = []
     # N - no of encoder and decoder blocks
-    for _ in range(N // 2):
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+    for _ in range(max(encoder_schedule) + 1):
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, fused = "qkv" if fused_qkv else None)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
-        encoder_block = EncoderBlock(encoder_self_attention_block, feed_forward_block, dropout)
+        encoder_block = EncoderBlock(encoder_self_attention_block, feed_forward_block, dropout, fused_norm)
         encoder_blocks.append(encoder_block)
 
 
     # create decoder blocks
     decoder_blocks = []
-    for _ in range(N // 2):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+    for _ in range(max(decoder_schedule) + 1):
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, fused = "qkv" if fused_qkv else None)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, fused = "kv" if fused_qkv else None)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
-        decoder_block = DecoderBlock(decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout )
+        decoder_block = DecoderBlock(decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout, fused_norm)
         decoder_blocks.append(decoder_block)
 
-    e1, e2, e3 = encoder_blocks
-    d1, d2, d3 = decoder_blocks
-
-    encoder_blocks1 = [e1, e2, e3, e3, e2, e1]
-    decoder_blocks1 = [d1, d2, d3, d3, d2, d1]
+    ## with the default "mirrored" schedule and N = 6 this is [e1, e2, e3, e3, e2, e1] and [d1, d2, d3, d3, d2, d1]
+    encoder_blocks1 = [encoder_blocks[i] for i in encoder_schedule]
+    decoder_blocks1 = [decoder_blocks[i] for i in decoder_schedule]
 
 
     # create the encoder and decoder
-    encoder = Encoder(nn.ModuleList(encoder_blocks1))
-    decoder = Decoder(nn.ModuleList(decoder_blocks1))
+    encoder = Encoder(nn.ModuleList(encoder_blocks1), fused_norm)
+    decoder = Decoder(nn.ModuleList(decoder_blocks1), fused_norm)
 
 
 
@@ -305,9 +567,442 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_length:
     return transformer
 
 
+def model_memory_report(model):
+    ## sizes in bytes of what the sharing schedule actually changes
+    ## parameters() and torch.save both store a shared tensor once, so shared blocks are only counted once
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    buffer_bytes = sum(b.numel() * b.element_size() for b in model.buffers())
+    return {
+        "parameters": sum(p.numel() for p in model.parameters()),
+        "parameter_bytes": param_bytes,
+        "adam_state_bytes": 2 * param_bytes, # exp_avg and exp_avg_sq per parameter
+        "checkpoint_bytes": param_bytes + buffer_bytes,
+    }
+
+
+def compare_sharing_schedules(src_vocab_size, tgt_vocab_size, seq_len, d_model = 512, N = 6, schedules = ("none", "mirrored", "cyclic")):
+    ## one line per schedule (same schedule for encoder and decoder) with parameter count, Adam state and checkpoint size
+    reports = {}
+    for schedule in schedules:
+        model = build_transformer(src_vocab_size, tgt_vocab_size, seq_len, seq_len, d_model = d_model, N = N, encoder_sharing = schedule, decoder_sharing = schedule)
+        reports[str(schedule)] = report = model_memory_report(model)
+        print(f"{str(schedule):>20} : {report['parameters']:>12,d} params, "
+              f"adam state {report['adam_state_bytes'] / 2**20:8.1f} MB, checkpoint {report['checkpoint_bytes'] / 2**20:8.1f} MB")
+    return reports
+
+# compare_sharing_schedules(tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(), cfg['seq_len'], cfg['d_model'])
+
+
+import time
+import torch.utils.checkpoint
+
+def set_activation_checkpointing(model, layers = None, every_k:int = None, encoder:bool = True, decoder:bool = True):
+    ## layers - explicit layer positions, every_k - positions 0, k, 2k, ... ; neither switches checkpointing off
+    ## a checkpointed position keeps only its input for backward and recomputes the attention probabilities and FFN activations
+    for stack, enabled in ((model.encoder, encoder), (model.decoder, decoder)):
+        positions = set()
+        if enabled and layers is not None:
+            positions = set(layers)
+        elif enabled and every_k:
+            positions = set(range(0, len(stack.layers), every_k))
+        stack.checkpoint_layers = positions
+    return model
+
+
+def saved_activation_bytes(fn):
+    ## runs fn() and adds up the bytes of every tensor autograd saves for backward, the memory activation checkpointing saves
+    total = [0]
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, total[0]
+
+
+def benchmark_activation_checkpointing(model, batch, loss_fn, device, settings = (None, 3, 2, 1), repeats = 3):
+    ## one training step (forward + backward) on batch (a Collator batch) for every setting of every_k
+    ## (None = off, 1 = every layer), reports the activation memory kept for backward, the CUDA peak if there is one, and the step time
+    model.train()
+    encoder_input = batch['encoder_input'].to(device)
+    decoder_input = batch['decoder_input'].to(device)
+    encoder_length = batch['encoder_length'].to(device)
+    decoder_length = batch['decoder_length'].to(device)
+    label = batch['label'].to(device)
+
+    def step():
+        encoder_output = model.encode(encoder_input, src_lengths = encoder_length)
+        decoder_output = model.decode(encoder_output, None, decoder_input, src_lengths = encoder_length, tgt_lengths = decoder_length, is_causal = True)
+        proj_output = model.project(decoder_output)
+        return loss_fn(proj_output.view(-1, proj_output.size(-1)), label.view(-1))
+
+    results = {}
+    for every_k in settings:
+        set_activation_checkpointing(model, every_k = every_k)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            loss, saved = saved_activation_bytes(step)
+            loss.backward()
+            model.zero_grad(set_to_none = True)
+        step_time = (time.perf_counter() - start) / repeats * 1000
+        peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else float('nan')
+        results[every_k] = {"saved_activation_mb": saved / 2**20, "peak_mb": peak, "step_ms": step_time}
+        print(f"every_k = {str(every_k):>4} : saved activations {saved / 2**20:8.1f} MB, peak {peak:8.1f} MB, step {step_time:8.1f} ms")
+    set_activation_checkpointing(model)
+    return results
+
+
+def benchmark_attention_backends(batch_size = 8, h = 8, seq_lengths = (32, 64, 128, 256), d_k = 64, chunk_size = 64, repeats = 20):
+    ## CPU timing of the three attention backends on random inputs with a causal mask, milliseconds per call
+    results = {}
+    dropout = nn.Dropout(0.0)
+    for seq_len in seq_lengths:
+        query = torch.randn(batch_size, h, seq_len, d_k)
+        key = torch.randn(batch_size, h, seq_len, d_k)
+        value = torch.randn(batch_size, h, seq_len, d_k)
+        mask = causal_mask(seq_len).unsqueeze(0) # [1, 1, seq_len, seq_len]
+        backends = {
+            "math": lambda: MultiHeadAttentionBlock.attention(query, key, value, mask, dropout),
+            "sdpa": lambda: MultiHeadAttentionBlock.sdpa_attention(query, key, value, mask, dropout),
+            "chunked": lambda: MultiHeadAttentionBlock.chunked_attention(query, key, value, mask, dropout, chunk_size),
+        }
+        with torch.no_grad():
+            for name, fn in backends.items():
+                fn() # warm up
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    fn()
+                results[(name, seq_len)] = (time.perf_counter() - start) / repeats * 1000
+                print(f"{name:>8} seq_len = {seq_len:4d} : {results[(name, seq_len)]:8.3f} ms")
+    return results
+
+# benchmark_attention_backends()
+
+
+def check_fused_residual_norm(batch_size = 8, seq_len = 64, d_model = 512, atol = 1e-5):
+    ## the fused ResidualConnection must give the same output and the same gradients as the existing one
+    torch.manual_seed(0)
+    reference, fused = ResidualConnection(0.0), ResidualConnection(0.0, fused = True)
+    with torch.no_grad():
+        for module in (reference, fused):
+            module.norm.alpha.fill_(1.3)
+            module.norm.bias.fill_(-0.2)
+    linear = nn.Linear(d_model, d_model)
+    x = torch.randn(batch_size, seq_len, d_model)
+    x_ref, x_fused = x.clone().requires_grad_(), x.clone().requires_grad_()
+    out_ref, out_fused = reference(x_ref, linear), fused(x_fused, linear)
+    assert torch.allclose(out_ref, out_fused, atol = atol), "fused residual/norm output differs"
+    out_ref.sum().backward()
+    out_fused.sum().backward()
+    assert torch.allclose(x_ref.grad, x_fused.grad, atol = atol), "fused residual/norm input gradient differs"
+    assert torch.allclose(reference.norm.alpha.grad, fused.norm.alpha.grad, rtol = 1e-4), "fused residual/norm alpha gradient differs"
+    print("fused residual/norm matches the reference")
+
+
+def benchmark_fused_residual_norm(batch_size = 8, seq_lengths = (32, 64, 128, 350), d_model = 512, repeats = 50):
+    ## CPU forward time of ResidualConnection with and without fusion, the sublayer is identity so only norm + residual is timed
+    results = {}
+    for seq_len in seq_lengths:
+        x = torch.randn(batch_size, seq_len, d_model)
+        for name, module in (("reference", ResidualConnection(0.0)), ("fused", ResidualConnection(0.0, fused = True))):
+            module.eval()
+            with torch.no_grad():
+                module(x, lambda y: y * 1.0)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    module(x, lambda y: y * 1.0)
+            results[(name, seq_len)] = (time.perf_counter() - start) / repeats * 1000
+            print(f"{name:>10} seq_len = {seq_len:4d} : {results[(name, seq_len)]:8.3f} ms")
+    return results
+
+# check_fused_residual_norm()
+# benchmark_fused_residual_norm()
+
+
+import json
+from collections import defaultdict
+
+## opt-in per module profiling: forward/backward hooks on the blocks below record wall time, analytic FLOPs, output (activation)
+## bytes and, on CUDA, the peak allocated memory of every call. Records are kept per layer POSITION: a block shared by
+## positions 0 and 5 is reported as encoder.layers.0.* and encoder.layers.5.*.
+## the k-th call of a shared module inside one Encoder / Decoder pass is mapped to its k-th position, which is the order the
+## layers run in. Switch activation checkpointing off while profiling, its recomputation in backward runs the layers again.
+## backward hooks need fused_norm off: the fused residual adds into the module output in place
+class ModuleProfiler:
+    PROFILED = (MultiHeadAttentionBlock, FeedForwardBlock, LayerNormalization, InputEmbeddings, ProjectionLayer)
+
+    def __init__(self, model, backward:bool = True):
+        self.model = getattr(model, 'module', model) # unwrap DistributedDataParallel
+        self.backward = backward
+        self.records = [] # one dict per call: name, kind, phase, start, ms, flops, activation_bytes, peak_bytes
+        self.handles = []
+        if backward and any(getattr(m, 'fused', False) for m in self.model.modules() if isinstance(m, ResidualConnection)):
+            raise ValueError("backward profiling does not work with fused_norm, use backward = False")
+
+    def __enter__(self):
+        ## every name a module is reachable under, in layer order
+        names = defaultdict(list)
+        for name, module in self.model.named_modules(remove_duplicate = False):
+            if isinstance(module, self.PROFILED):
+                names[module].append(name)
+        self.call_count = defaultdict(int)
+        self.backward_stack = defaultdict(list)
+        self.t0 = time.perf_counter()
+        for module, module_names in names.items():
+            self.handles.append(module.register_forward_pre_hook(self._pre_forward, with_kwargs = True))
+            self.handles.append(module.register_forward_hook(self._make_post_forward(module_names), with_kwargs = True))
+            if self.backward:
+                self.handles.append(module.register_full_backward_pre_hook(self._pre_backward))
+                self.handles.append(module.register_full_backward_hook(self._post_backward))
+        ## a new Encoder / Decoder pass starts again at the first position of every shared module
+        for stack in (self.model.encoder, self.model.decoder):
+            self.handles.append(stack.register_forward_pre_hook(lambda module, args: self.call_count.clear()))
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _now(self):
+        return time.perf_counter() - self.t0
+
+    @staticmethod
+    def _reset_peak(x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+            torch.cuda.reset_peak_memory_stats(x.device)
+
+    @staticmethod
+    def _peak(x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+            return torch.cuda.max_memory_allocated(x.device)
+        return None
+
+    def _pre_forward(self, module, args, kwargs):
+        self._reset_peak(args[0])
+        if isinstance(module, MultiHeadAttentionBlock):
+            ## cross attention with a filled cache reuses the projected keys / values, has to be known before the call fills it
+            cache = args[4] if len(args) > 4 else kwargs.get('cache')
+            static_kv = args[5] if len(args) > 5 else kwargs.get('static_kv', False)
+            module._profile_reuse_kv = cache is not None and static_kv and "key" in cache
+        module._profile_start = self._now()
+
+    def _make_post_forward(self, module_names):
+        def post_forward(module, args, kwargs, output):
+            end = self._now()
+            k = self.call_count[module]
+            self.call_count[module] += 1
+            name = module_names[k % len(module_names)]
+            if self.backward and torch.is_grad_enabled():
+                self.backward_stack[module].append(name)
+            self.records.append({
+                "name": name, "kind": type(module).__name__, "phase": "forward",
+                "start": module._profile_start, "ms": (end - module._profile_start) * 1000,
+                "flops": module_flops(module, args, kwargs, output),
+                "activation_bytes": output.numel() * output.element_size(),
+                "peak_bytes": self._peak(output),
+            })
+        return post_forward
+
+    def _pre_backward(self, module, grad_output):
+        module._profile_backward_start = self._now()
+
+    def _post_backward(self, module, grad_input, grad_output):
+        ## shared modules run backward in the reverse order of their forward calls
+        end = self._now()
+        name = self.backward_stack[module].pop() if self.backward_stack[module] else type(module).__name__
+        start = module._profile_backward_start
+        forward_flops = next((r["flops"] for r in reversed(self.records) if r["name"] == name and r["phase"] == "forward"), 0)
+        self.records.append({
+            "name": name, "kind": type(module).__name__, "phase": "backward",
+            "start": start, "ms": (end - start) * 1000,
+            "flops": 2 * forward_flops, # gradients wrt the inputs and wrt the weights
+            "activation_bytes": 0, "peak_bytes": None,
+        })
+
+    def summary(self):
+        ## per (name, phase): calls, total ms, FLOPs, activation bytes, max peak
+        rows = {}
+        for r in self.records:
+            row = rows.setdefault((r["name"], r["phase"]), {"name": r["name"], "kind": r["kind"], "phase": r["phase"], "calls": 0,
+                                                           "ms": 0.0, "flops": 0, "activation_bytes": 0, "peak_bytes": None})
+            row["calls"] += 1
+            row["ms"] += r["ms"]
+            row["flops"] += r["flops"]
+            row["activation_bytes"] += r["activation_bytes"]
+            if r["peak_bytes"] is not None:
+                row["peak_bytes"] = max(row["peak_bytes"] or 0, r["peak_bytes"])
+        return list(rows.values())
+
+    def table(self, sort_by:str = "ms", limit:int = None):
+        rows = sorted(self.summary(), key = lambda row: row[sort_by] or 0, reverse = sort_by != "name")[:limit]
+        lines = [f"{'name':<55} {'phase':<9} {'calls':>6} {'ms':>10} {'GFLOP':>9} {'GFLOP/s':>9} {'act MB':>9} {'peak MB':>9}"]
+        for row in rows:
+            gflop = row["flops"] / 1e9
+            peak = f"{row['peak_bytes'] / 2**20:9.1f}" if row["peak_bytes"] is not None else f"{'-':>9}"
+            lines.append(f"{row['name']:<55} {row['phase']:<9} {row['calls']:>6d} {row['ms']:>10.3f} {gflop:>9.3f} "
+                         f"{gflop / max(row['ms'] / 1000, 1e-9):>9.1f} {row['activation_bytes'] / 2**20:>9.2f} {peak}")
+        return "\n".join(lines)
+
+    def chrome_trace(self, path):
+        ## open in chrome://tracing or https://ui.perfetto.dev, forward and backward on separate rows
+        tids = {"forward": 0, "backward": 1}
+        events = [{"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": phase}} for phase, tid in tids.items()]
+        events += [{"name": r["name"], "cat": r["kind"], "ph": "X", "pid": 0, "tid": tids[r["phase"]],
+                   "ts": r["start"] * 1e6, "dur": r["ms"] * 1000,
+                   "args": {"flops": r["flops"], "activation_bytes": r["activation_bytes"], "peak_bytes": r["peak_bytes"]}}
+                  for r in self.records]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+def module_flops(module, args, kwargs, output):
+    ## analytic forward FLOPs (a multiply-add counts 2) from the shapes of one call
+    if isinstance(module, MultiHeadAttentionBlock):
+        q, k = args[0], args[1]
+        d = module.d_model
+        cache = args[4] if len(args) > 4 else kwargs.get('cache')
+        rows_q = q.numel() // d
+        ## with a cache self attention only projects the new tokens (k), cached cross attention projects nothing
+        projected_kv = 0 if getattr(module, '_profile_reuse_kv', False) else k.numel() // d
+        key_len = cache["key"].shape[-2] if cache is not None and "key" in cache else k.shape[-2]
+        return 2 * d * d * (2 * rows_q + 2 * projected_kv) + 4 * rows_q * key_len * d
+    if isinstance(module, FeedForwardBlock):
+        rows = args[0].numel() // module.linear_1.in_features
+        return 4 * rows * module.linear_1.in_features * module.linear_1.out_features
+    if isinstance(module, LayerNormalization):
+        return 5 * args[0].numel()
+    if isinstance(module, InputEmbeddings):
+        return output.numel()
+    if isinstance(module, ProjectionLayer):
+        return 2 * output.numel() * module.proj.in_features + 3 * output.numel()
+    return 0
+
+
+def profile_model(model, batch, loss_fn, device, train:bool = True, trace_path:str = None, sort_by:str = "ms"):
+    ## one encode + decode + project pass on a Collator batch (with backward if train), prints the per position table
+    encoder_input = batch['encoder_input'].to(device)
+    decoder_input = batch['decoder_input'].to(device)
+    encoder_length = batch['encoder_length'].to(device)
+    decoder_length = batch['decoder_length'].to(device)
+    label = batch['label'].to(device)
+    model.train(train)
+    with ModuleProfiler(model, backward = train) as profiler, torch.set_grad_enabled(train):
+        proj_output = model(encoder_input, decoder_input, encoder_length, decoder_length)
+        if train:
+            loss_fn(proj_output.view(-1, proj_output.size(-1)), label.view(-1)).backward()
+            model.zero_grad(set_to_none = True)
+    print(profiler.table(sort_by))
+    if trace_path:
+        profiler.chrome_trace(trace_path)
+    return profiler
+
+# profile_model(model, next(iter(train_dataloader)), loss_fn, device, trace_path = "trace.json")
+
+
+import copy
+from pathlib import Path
+
+## graphs for serving without the python model code. Both take lengths instead of dense masks so batch and sequence
+## lengths stay dynamic.
+## encoder: src [B, S_src], src_lengths [B] -> encoder_output [B, S_src, d_model]
+## decoder step: encoder_output, src_lengths, decoder_input [B, S_tgt] -> log probabilities of the next token [B, vocab_size]
+## the step graph is stateless (it re-runs the prefix), the python KV cache is not part of the exported graph
+class EncoderGraph(nn.Module):
+    def __init__(self, model: Transformer)-> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, src, src_lengths):
+        return self.model.encode(src, src_lengths = src_lengths)
+
+
+class DecoderStepGraph(nn.Module):
+    def __init__(self, model: Transformer)-> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, encoder_output, src_lengths, decoder_input):
+        out = self.model.decode(encoder_output, None, decoder_input, src_lengths = src_lengths, is_causal = True)
+        return self.model.project(out[:, -1])
+
+
+def export_inference_graphs(model, export_dir, src_vocab_size:int, tgt_vocab_size:int, onnx:bool = True, opset_version:int = 17):
+    ## writes encoder.pt / decoder_step.pt (TorchScript, traced) and encoder.onnx / decoder_step.onnx to export_dir
+    export_dir = Path(export_dir)
+    export_dir.mkdir(parents = True, exist_ok = True)
+    ## a CPU copy in eval mode, the caller's model stays on its device and in its train / eval mode
+    model = copy.deepcopy(model).cpu().eval()
+    encoder, decoder_step = EncoderGraph(model).eval(), DecoderStepGraph(model).eval()
+
+    ## example inputs, their sizes are only used for tracing, the axes stay dynamic
+    src = torch.randint(4, src_vocab_size, (2, 12))
+    src_lengths = torch.tensor([12, 7])
+    decoder_input = torch.randint(4, tgt_vocab_size, (2, 5))
+
+    with torch.no_grad():
+        encoder_output = encoder(src, src_lengths)
+        torch.jit.trace(encoder, (src, src_lengths)).save(str(export_dir / "encoder.pt"))
+        torch.jit.trace(decoder_step, (encoder_output, src_lengths, decoder_input)).save(str(export_dir / "decoder_step.pt"))
+
+        if onnx:
+            torch.onnx.export(encoder, (src, src_lengths), str(export_dir / "encoder.onnx"),
+                              input_names = ["src", "src_lengths"], output_names = ["encoder_output"],
+                              dynamic_axes = {"src": {0: "batch", 1: "src_len"}, "src_lengths": {0: "batch"}, "encoder_output": {0: "batch", 1: "src_len"}},
+                              opset_version = opset_version)
+            torch.onnx.export(decoder_step, (encoder_output, src_lengths, decoder_input), str(export_dir / "decoder_step.onnx"),
+                              input_names = ["encoder_output", "src_lengths", "decoder_input"], output_names = ["log_probs"],
+                              dynamic_axes = {"encoder_output": {0: "batch", 1: "src_len"}, "src_lengths": {0: "batch"},
+                                              "decoder_input": {0: "batch", 1: "tgt_len"}, "log_probs": {0: "batch"}},
+                              opset_version = opset_version)
+    print(f"exported inference graphs to {export_dir}")
+
+
+def check_export_parity(model, export_dir, src_vocab_size:int, tgt_vocab_size:int, atol:float = 1e-4):
+    ## compares the exported graphs with Transformer.encode / decode / project on inputs of OTHER shapes than the ones
+    ## used for tracing, so a graph with frozen batch or sequence sizes fails here
+    export_dir = Path(export_dir)
+    model = copy.deepcopy(model).cpu().eval() # same as export_inference_graphs
+    src = torch.randint(4, src_vocab_size, (3, 17))
+    src_lengths = torch.tensor([17, 9, 4])
+    decoder_input = torch.randint(4, tgt_vocab_size, (3, 8))
+
+    with torch.no_grad():
+        expected_encoder_output = model.encode(src, src_lengths = src_lengths)
+        out = model.decode(expected_encoder_output, None, decoder_input, src_lengths = src_lengths, is_causal = True)
+        expected_log_probs = model.project(out[:, -1])
+
+        encoder = torch.jit.load(str(export_dir / "encoder.pt"))
+        decoder_step = torch.jit.load(str(export_dir / "decoder_step.pt"))
+        encoder_output = encoder(src, src_lengths)
+        log_probs = decoder_step(encoder_output, src_lengths, decoder_input)
+    assert torch.allclose(encoder_output, expected_encoder_output, atol = atol), "TorchScript encoder does not match Transformer.encode"
+    assert torch.allclose(log_probs, expected_log_probs, atol = atol), "TorchScript decoder step does not match Transformer.decode/project"
+    print("TorchScript graphs match the model")
+
+    if (export_dir / "encoder.onnx").exists():
+        try:
+            import onnxruntime
+        except ImportError:
+            print("onnxruntime is not installed, skipping the ONNX parity check")
+            return
+        encoder = onnxruntime.InferenceSession(str(export_dir / "encoder.onnx"))
+        decoder_step = onnxruntime.InferenceSession(str(export_dir / "decoder_step.onnx"))
+        encoder_output = encoder.run(None, {"src": src.numpy(), "src_lengths": src_lengths.numpy()})[0]
+        log_probs = decoder_step.run(None, {"encoder_output": encoder_output, "src_lengths": src_lengths.numpy(), "decoder_input": decoder_input.numpy()})[0]
+        assert torch.allclose(torch.from_numpy(encoder_output), expected_encoder_output, atol = atol), "ONNX encoder does not match Transformer.encode"
+        assert torch.allclose(torch.from_numpy(log_probs), expected_log_probs, atol = atol), "ONNX decoder step does not match Transformer.decode/project"
+        print("ONNX graphs match the model")
+
 
 import torch
 import torch.nn
+import numpy as np
 from torch.utils.data import Dataset
 
 ## convert from one language to another
@@ -328,6 +1023,12 @@ class BillingualDataset(Dataset):
     def __len__(self):
         return len(self.ds)
 
+    def lengths(self):
+        ## [N, 2] padded source (with [SOS]/[EOS]) and target (with [SOS]) length of every sample, used by TokenBudgetBatchSampler
+        src = self.tokenizer_src.encode_batch([item['translation'][self.src_lang] for item in self.ds])
+        tgt = self.tokenizer_tgt.encode_batch([item['translation'][self.tgt_lang] for item in self.ds])
+        return np.asarray([(len(s.ids) + 2, len(t.ids) + 1) for s, t in zip(src, tgt)], dtype = np.int64).reshape(-1, 2)
+
 
     def __getitem__(self, idx):
         ## extracting the text fromt he input
@@ -391,9 +1092,9 @@ class BillingualDataset(Dataset):
             "decoder_input" : decoder_input,
             "encoder_str_length":len(enc_input_tokens),
             "decoder_str_length":len(dec_input_tokens),
-            "encoder_mask" : (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(),  ## (1,1,seq_len)
+            ## no dense masks are stored per sample any more, they are derived from the lengths inside attention
+            ## (MultiHeadAttentionBlock.build_mask) - the encoder mask is the padding mask, the decoder mask is padding & causal
             # where ever encoder token is not equal to pad token, pass TRUE, and where it is equal to pad pass FALSE , thereforE of type(T, T ,T, F, F, F, F)
-            "decoder_mask" : (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)),  # (1,seq_len) & (1, seq_len, seq_len)
             ## seq_len = 10
             ## SOS    I  GOT   A   CAT    PAD    PAD    PAD    PAD    PAD    PAD
             ## TRUE TRUE TRUE TRUE TRUE  FALSE  FALSE  FALSE  FALSE  FALSE  FALSE
@@ -431,6 +1132,130 @@ def causal_mask(size):
     mask = torch.triu(torch.ones((1, size, size)), diagonal = 1).type(torch.int)
     return mask == 0
 
+
+from torch.utils.data import Sampler
+
+## groups samples of similar length into buckets and fills each batch up to max_tokens (batch_size * padded length of the longer side)
+## instead of a fixed number of sentences. Every epoch the samples are shuffled inside their bucket and the batches are shuffled
+## among each other, so the order changes but a batch never mixes very short and very long sentences
+class TokenBudgetBatchSampler(Sampler):
+    ## lengths [N, 2] - padded source and target length of every sample (BillingualDataset.lengths)
+    ## num_replicas / rank shard the batches for data parallel training: every rank gets the same number of batches
+    def __init__(self, lengths, max_tokens:int, bucket_width:int = 8, shuffle:bool = True, seed:int = 0, num_replicas:int = 1, rank:int = 0):
+        self.lengths = np.asarray(lengths, dtype = np.int64).reshape(-1, 2)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start_batch = 0 # position in the epoch to resume from, see Trainer.train_epoch
+
+        ## bucket b holds the samples whose longer side has length in ((b - 1) * bucket_width, b * bucket_width]
+        longest = self.lengths.max(axis = 1, initial = 0)
+        bucket_ids = (longest + bucket_width - 1) // bucket_width
+        self.buckets = []
+        for b in np.unique(bucket_ids):
+            indices = np.nonzero(bucket_ids == b)[0]
+            ## the batch size of a bucket is fixed by its longest sample, so the number of batches does not change between epochs
+            bucket_len = int(longest[indices].max())
+            batch_size = max(1, max_tokens // bucket_len)
+            self.buckets.append((indices, batch_size))
+
+    def set_epoch(self, epoch:int):
+        self.epoch = epoch
+        self.start_batch = 0
+
+    def batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for indices, batch_size in self.buckets:
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            batches.extend(indices[i : i + batch_size].tolist() for i in range(0, len(indices), batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def num_batches(self):
+        return sum((len(indices) + batch_size - 1) // batch_size for indices, batch_size in self.buckets)
+
+    def __iter__(self):
+        ## same seed on every rank, so all ranks build the same batch list and take disjoint slices of it
+        batches = self.batches()
+        start, self.start_batch = self.start_batch * self.num_replicas + self.rank, 0
+        return iter(batches[start : len(self) * self.num_replicas : self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches() // self.num_replicas
+
+    def padding_efficiency(self):
+        ## fraction of the padded positions that hold real tokens, 1.0 means no padding at all. The Collator pads the source and
+        ## the target to their own longest sample, so it is counted per side and combined over both (as TrainingMetrics.padding_ratio)
+        real, padded = np.zeros(2, dtype = np.int64), np.zeros(2, dtype = np.int64)
+        for batch in self.batches():
+            batch_lengths = self.lengths[batch] # [B, 2]
+            real += batch_lengths.sum(axis = 0)
+            padded += batch_lengths.max(axis = 0) * len(batch)
+        return {"source": float(real[0] / max(padded[0], 1)), "target": float(real[1] / max(padded[1], 1)),
+                "combined": float(real.sum() / max(padded.sum(), 1))}
+
+
+## same samples as BillingualDataset, but the token ids are read from a TokenCache (see get_or_build_token_cache)
+## instead of running the tokenizers on the raw text for every sample
+class TokenizedBillingualDataset(Dataset):
+    def __init__(self, token_cache, rows, ds, tokenizer_tgt, src_lang, tgt_lang, seq_len):
+        super().__init__()
+        self.seq_len = seq_len
+        self.token_cache = token_cache
+        self.rows = np.asarray(rows, dtype = np.int64) # rows of the token cache that belong to this split
+        self.ds = ds # raw dataset, only used for src_text / tgt_text
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+
+        self.sos_id = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_id = tokenizer_tgt.token_to_id("[EOS]")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lengths(self):
+        ## same [N, 2] source / target lengths as BillingualDataset.lengths, read from the offsets without touching the token ids
+        src = self.token_cache.src_lengths()[self.rows] + 2
+        tgt = self.token_cache.tgt_lengths()[self.rows] + 1
+        return np.stack([src, tgt], axis = 1).astype(np.int64)
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        ## slices of the memory mapped arrays, no copy and no tokenizer call
+        enc_input_tokens = self.token_cache.src(row)
+        dec_input_tokens = self.token_cache.tgt(row)
+
+        if len(enc_input_tokens) + 2 > self.seq_len or len(dec_input_tokens) + 1 > self.seq_len:
+            raise ValueError("Sentence too long")
+
+        ## [SOS] tokens [EOS] / [SOS] tokens / tokens [EOS], written straight into int64 buffers
+        encoder_input = np.empty(len(enc_input_tokens) + 2, dtype = np.int64)
+        encoder_input[0], encoder_input[1:-1], encoder_input[-1] = self.sos_id, enc_input_tokens, self.eos_id
+        decoder_input = np.empty(len(dec_input_tokens) + 1, dtype = np.int64)
+        decoder_input[0], decoder_input[1:] = self.sos_id, dec_input_tokens
+        label = np.empty(len(dec_input_tokens) + 1, dtype = np.int64)
+        label[:-1], label[-1] = dec_input_tokens, self.eos_id
+
+        encoder_input = torch.from_numpy(encoder_input)
+        decoder_input = torch.from_numpy(decoder_input)
+        translation = self.ds[int(self.token_cache.index[row])]['translation']
+
+        return {
+            "encoder_input" : encoder_input,
+            "decoder_input" : decoder_input,
+            "encoder_str_length":len(enc_input_tokens),
+            "decoder_str_length":len(dec_input_tokens),
+            "label" : torch.from_numpy(label),
+            "src_text" : translation[self.src_lang],
+            "tgt_text" : translation[self.tgt_lang],
+        }
+
 # from model import build_transformer
 # from dataset import BillingualDataset, causal_mask
 # from config import get_config, get_weights_file_path
@@ -443,7 +1268,7 @@ def causal_mask(size):
 from torchtext import datasets as datasets
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, random_split, DistributedSampler
 from torch.optim.lr_scheduler import LambdaLR
 
 import warnings
@@ -473,18 +1298,17 @@ def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_
     encoder_output = model.encode(source, source_mask)
     ## initialise decoder input with sos token
     decoder_input = torch.empty(1,1).fill_(sos_idx).type_as(source).to(device)
+    ## keys and values of the previous tokens are kept per layer, so only the newest token goes through the decoder
+    cache = model.init_decode_cache()
     while True:
         if decoder_input.size(1) == max_len: # if we reach max length before getting the eos token
             break
 
-        ## build mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-
-        # calculate output
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
+        # calculate output, no causal mask needed as the newest token can see all the previous ones
+        out = model.decode(encoder_output, source_mask, decoder_input[:, -1:], None, cache)
 
-        # get next token
-        prob = model.project(out[:, -1])
+        # get next token, the raw logits have the same argmax as the log probabilities
+        prob = model.project_logits(out[:, -1])
         _, next_word = torch.max(prob, dim = 1)
 
         decoder_input = torch.cat(
@@ -497,13 +1321,430 @@ def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_
     return decoder_input.squeeze(0)
 
 
-def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples= 2):
-    model.eval()
-    count = 0
+def batched_greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device, source_lengths = None, candidates = None, on_finished = None, encoder_output = None):
+    ## greedy decoding of a whole padded batch source [B, seq_len] at once
+    ## rows that already emitted [EOS] are marked finished and only get [PAD] afterwards
+    ## the source padding is given either as source_mask [B, 1, 1, seq_len] or as source_lengths [B] (then source_mask = None)
+    ## candidates [B, C] (shortlist_candidates) restricts the output projection to a per sentence vocabulary shortlist
+    ## on_finished(row, ids) is called as soon as a row emits [EOS] (rows that hit max_len at the end), ids is its decoded row so far
+    ## encoder_output - model.encode(source, source_mask, source_lengths) if it is already known (TranslationCache)
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask, source_lengths)
+    decoder_input = torch.full((source.size(0), 1), sos_idx, dtype = source.dtype, device = device) # [B, 1]
+    finished = torch.zeros(source.size(0), dtype = torch.bool, device = device)
+    cache = model.init_decode_cache()
+    ## the shortlisted projection rows are gathered (and dequantized) once for the whole decode
+    candidate_weights = model.gather_candidates(candidates) if candidates is not None else None
+    while decoder_input.size(1) < max_len:
+        out = model.decode(encoder_output, source_mask, decoder_input[:, -1:], None, cache, src_lengths = source_lengths)
+        next_word = model.project_logits(out[:, -1], candidate_weights).argmax(dim = -1) # [B]
+        if candidates is not None:
+            next_word = candidates.gather(1, next_word.unsqueeze(1)).squeeze(1) # position in the shortlist -> target id
+        next_word = next_word.masked_fill(finished, pad_idx)
+        decoder_input = torch.cat([decoder_input, next_word.unsqueeze(1)], dim = 1)
+        newly_finished = (next_word == eos_idx) & ~finished
+        finished = finished | newly_finished
+        if on_finished is not None:
+            for row in newly_finished.nonzero().flatten().tolist():
+                on_finished(row, decoder_input[row])
+        ## stop as soon as every row has emitted [EOS]
+        if finished.all():
+            break
+
+    if on_finished is not None:
+        for row in (~finished).nonzero().flatten().tolist():
+            on_finished(row, decoder_input[row])
+    return decoder_input # [B, <= max_len]
+
+
+def strip_padding(ids, tokenizer_tgt):
+    ## cut a decoded row at the first [EOS] and drop [SOS]/[PAD] before handing it to tokenizer_tgt.decode
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    if eos_idx in ids:
+        ids = ids[: ids.index(eos_idx)]
+    return [i for i in ids if i != sos_idx and i != pad_idx]
+
 
+def beam_search_decode(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size = 4, length_penalty = 0.6, source_lengths = None, encoder_output = None):
+    ## batched beam search over all the sentences in source [B, seq_len] and all the beams at once
+    ## returns the best hypothesis of every sentence [B, <= max_len] (padded with [PAD] after [EOS]) and its normalised score [B]
+    ## encoder_output - model.encode(source, source_mask, source_lengths) if it is already known (TranslationCache)
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    ## encode every source once. The beam dimension is added as a size 1 dimension which broadcasts inside attention,
+    ## so the encoder output (and the cross attention keys/values cached from it) is never copied per beam
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask, source_lengths)
+    encoder_output = encoder_output.unsqueeze(1) # [B, 1, seq_len, d_model]
+    if source_mask is not None:
+        source_mask = source_mask.unsqueeze(1) # [B, 1, 1, 1, seq_len]
+    if source_lengths is not None:
+        source_lengths = source_lengths.unsqueeze(1) # [B, 1]
+    cache = model.init_decode_cache()
+
+    tokens = torch.full((batch_size, beam_size, 1), sos_idx, dtype = torch.int64, device = device) # [B, beam, 1]
+    ## only the first beam is alive at the start, otherwise all beams would pick the same tokens
+    scores = torch.full((batch_size, beam_size), float('-inf'), device = device)
+    scores[:, 0] = 0.0
+    finished = torch.zeros(batch_size, beam_size, dtype = torch.bool, device = device)
+    lengths = torch.zeros(batch_size, beam_size, dtype = torch.int64, device = device)
+    batch_idx = torch.arange(batch_size, device = device).unsqueeze(1) # [B, 1]
+    finished_row = None
+
+    for _ in range(max_len - 1):
+        out = model.decode(encoder_output, source_mask, tokens[:, :, -1:], None, cache, src_lengths = source_lengths) # [B, beam, 1, d_model]
+        log_probs = model.project(out[:, :, -1]).float() # [B, beam, vocab_size]
+        vocab_size = log_probs.size(-1)
+
+        ## a finished hypothesis can only be extended with [PAD] at no cost, so it keeps exactly one candidate with its own score
+        if finished_row is None:
+            finished_row = torch.full((vocab_size,), float('-inf'), device = device)
+            finished_row[pad_idx] = 0.0
+        log_probs = torch.where(finished.unsqueeze(-1), finished_row, log_probs)
+
+        ## expand every beam with every token and keep the top beam_size candidates of each sentence
+        candidates = (scores.unsqueeze(-1) + log_probs).view(batch_size, -1) # [B, beam * vocab_size]
+        scores, top_idx = candidates.topk(beam_size, dim = -1)
+        beam_idx = torch.div(top_idx, vocab_size, rounding_mode = 'floor') # [B, beam]
+        next_word = top_idx % vocab_size
+
+        ## reorder everything that belongs to a hypothesis to follow its parent beam
+        tokens = torch.cat([tokens[batch_idx, beam_idx], next_word.unsqueeze(-1)], dim = -1)
+        finished = finished[batch_idx, beam_idx]
+        lengths = lengths[batch_idx, beam_idx] + (~finished).long()
+        finished = finished | (next_word == eos_idx)
+        for layer_cache in cache:
+            layer_cache["self"]["key"] = layer_cache["self"]["key"][batch_idx, beam_idx]
+            layer_cache["self"]["value"] = layer_cache["self"]["value"][batch_idx, beam_idx]
+
+        ## stop early once every hypothesis of every sentence has emitted [EOS]
+        if finished.all():
+            break
+
+    ## length normalisation (Wu et al. 2016) so that short hypotheses are not always preferred
+    penalty = ((5.0 + lengths.float()) / 6.0) ** length_penalty
+    normalised = scores / penalty
+    best_scores, best = normalised.max(dim = -1) # [B]
+    best_tokens = tokens[torch.arange(batch_size, device = device), best] # [B, seq]
+    return best_tokens, best_scores
+
+
+def translate_dataset(model, dataloader, tokenizer_tgt, max_len, device, max_batches = None, shortlist = None):
+    ## batched greedy translation of every sentence of dataloader, returns (source_texts, expected, predicted)
+    ## shortlist (get_or_build_shortlist) decodes over a per sentence vocabulary shortlist instead of the full target vocabulary
     source_texts = []
     expected = []
     predicted = []
+    with torch.no_grad():
+        for batch_num, batch in enumerate(dataloader):
+            if max_batches is not None and batch_num == max_batches:
+                break
+            encoder_input = batch['encoder_input'].to(device) # [B, seq_len]
+            encoder_length = batch['encoder_length'].to(device) # [B]
+
+            candidates = shortlist_candidates(shortlist, encoder_input, encoder_length) if shortlist is not None else None
+            model_out = batched_greedy_decode(model, encoder_input, None, tokenizer_tgt, max_len, device, source_lengths = encoder_length, candidates = candidates)
+
+            model_out_ids = [strip_padding(row, tokenizer_tgt) for row in model_out.detach().cpu().tolist()]
+            source_texts.extend(batch["src_text"])
+            expected.extend(batch["tgt_text"])
+            predicted.extend(tokenizer_tgt.decode_batch(model_out_ids))
+    return source_texts, expected, predicted
+
+
+## continuous batching: a fixed number of decoding slots, a sentence leaves its slot as soon as it emits [EOS] (or reaches
+## max_len) and the next queued sentence takes the slot at the following step, so no slot waits for the longest row.
+## every slot is at its own target position: the self attention cache is a preallocated [slots, h, max_len, d_k] buffer written
+## at per row positions, PositionalEncoding gets the [slots] position tensor and the keys after a row's position are masked
+## with tgt_lengths = positions + 1. The cross attention keys/values of an admitted sentence are spliced into its slot.
+from collections import deque
+from torch.nn.utils.rnn import pad_sequence
+
+class ContinuousBatchScheduler:
+    def __init__(self, model, tokenizer_src, tokenizer_tgt, device, max_len:int, num_slots:int = 16, max_src_len:int = None):
+        self.model = model.eval()
+        self.tokenizer_src = tokenizer_src
+        self.tokenizer_tgt = tokenizer_tgt
+        self.device = device
+        self.max_len = max_len
+        self.max_src_len = max_src_len or max_len
+        self.num_slots = num_slots
+        self.src_sos = tokenizer_src.token_to_id('[SOS]')
+        self.src_eos = tokenizer_src.token_to_id('[EOS]')
+        self.src_pad = tokenizer_src.token_to_id('[PAD]')
+        self.sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+        self.eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+        self.queue = deque()
+
+        ## per slot state
+        self.active = torch.zeros(num_slots, dtype = torch.bool, device = device)
+        self.positions = torch.zeros(num_slots, dtype = torch.int64, device = device) # position of the token fed at the next step
+        self.src_lengths = torch.ones(num_slots, dtype = torch.int64, device = device)
+        self.last_token = torch.full((num_slots,), self.sos_idx, dtype = torch.int64, device = device)
+        self.requests = [None] * num_slots
+        self.tokens = [[] for _ in range(num_slots)]
+        self.steps = 0
+        self.active_slot_steps = 0
+
+        ## slot cache, one entry per layer position; every position shares the same positions tensor
+        dtype = next(model.parameters()).dtype
+        self.cache = model.init_decode_cache()
+        for layer, layer_cache in zip(model.decoder.layers, self.cache):
+            attention = layer.self_attention_block
+            shape = (num_slots, attention.h, self.max_len, attention.d_k)
+            layer_cache["self"].update(key = torch.zeros(shape, dtype = dtype, device = device), value = torch.zeros(shape, dtype = dtype, device = device),
+                                       positions = self.positions)
+            shape = (num_slots, attention.h, self.max_src_len, attention.d_k)
+            layer_cache["cross"].update(key = torch.zeros(shape, dtype = dtype, device = device), value = torch.zeros(shape, dtype = dtype, device = device))
+
+    def submit(self, text:str, request = None):
+        ## request is handed back with the translation, defaults to the text itself
+        ids = self.tokenizer_src.encode(text).ids[: self.max_src_len - 2]
+        self.queue.append(([self.src_sos] + ids + [self.src_eos], text if request is None else request))
+
+    def admit(self):
+        ## fill the free slots from the queue: one encode for all admitted sentences, their cross attention keys/values are
+        ## written into their slots (computed once per shared block, the mirrored positions see the same encoder output)
+        free = (~self.active).nonzero().flatten().tolist()[: len(self.queue)]
+        if not free:
+            return
+        admitted = [self.queue.popleft() for _ in free]
+        slots = torch.tensor(free, dtype = torch.int64, device = self.device)
+        source = pad_sequence([torch.tensor(ids, dtype = torch.int64) for ids, _ in admitted], batch_first = True, padding_value = self.src_pad).to(self.device)
+        lengths = torch.tensor([len(ids) for ids, _ in admitted], dtype = torch.int64, device = self.device)
+        encoder_output = self.model.encode(source, src_lengths = lengths) # [n, L, d_model]
+        projected = {}
+        for layer, layer_cache in zip(self.model.decoder.layers, self.cache):
+            block = layer.cross_attention_block
+            if block not in projected:
+                projected[block] = block.project_kv(encoder_output)
+            key, value = projected[block]
+            layer_cache["cross"]["key"][slots, :, : key.shape[-2]] = key
+            layer_cache["cross"]["value"][slots, :, : value.shape[-2]] = value
+        self.src_lengths[slots] = lengths
+        self.positions[slots] = 0
+        self.last_token[slots] = self.sos_idx
+        self.active[slots] = True
+        for slot, (_, request) in zip(free, admitted):
+            self.requests[slot] = request
+            self.tokens[slot] = []
+
+    def step(self):
+        ## one decoding step of every slot, returns the (request, translation) pairs that finished at this step
+        out = self.model.decode(None, None, self.last_token.unsqueeze(1), None, self.cache,
+                                src_lengths = self.src_lengths, tgt_lengths = self.positions + 1) # [slots, 1, d_model]
+        next_word = self.model.project_logits(out[:, -1]).argmax(dim = -1) # [slots]
+        self.steps += 1
+        self.active_slot_steps += int(self.active.sum())
+
+        ## idle slots run along (their rows are ignored), they keep position 0 so they never run past the buffers
+        self.positions.add_(self.active.long())
+        self.last_token.copy_(torch.where(self.active, next_word, self.last_token))
+        ## the decoded row is [SOS] + tokens, it may not be longer than max_len (as in batched_greedy_decode)
+        done = self.active & ((next_word == self.eos_idx) | (self.positions + 1 >= self.max_len))
+
+        finished = []
+        for slot, word in zip(self.active.nonzero().flatten().tolist(), next_word[self.active].tolist()):
+            self.tokens[slot].append(word)
+        for slot in done.nonzero().flatten().tolist():
+            ids = strip_padding([self.sos_idx] + self.tokens[slot], self.tokenizer_tgt)
+            finished.append((self.requests[slot], self.tokenizer_tgt.decode(ids)))
+            self.requests[slot] = None
+        self.active &= ~done
+        self.positions.masked_fill_(~self.active, 0)
+        return finished
+
+    def run(self):
+        ## decode everything submitted, yields (request, translation) in the order the sentences finish
+        with torch.no_grad():
+            while self.queue or self.active.any():
+                self.admit()
+                yield from self.step()
+
+    def slot_utilization(self):
+        ## fraction of slot steps that decoded a live sentence
+        return self.active_slot_steps / max(self.steps * self.num_slots, 1)
+
+
+def translate_continuous(model, sentences, tokenizer_src, tokenizer_tgt, max_len, device, num_slots:int = 16):
+    ## translations of sentences in their original order
+    scheduler = ContinuousBatchScheduler(model, tokenizer_src, tokenizer_tgt, device, max_len, num_slots)
+    for i, sentence in enumerate(sentences):
+        scheduler.submit(sentence, i)
+    translations = [None] * len(sentences)
+    for i, translation in scheduler.run():
+        translations[i] = translation
+    return translations, scheduler
+
+
+def benchmark_continuous_batching(model, sentences, tokenizer_src, tokenizer_tgt, max_len, device, num_slots:int = 16):
+    ## sentences / second of static batches (batched_greedy_decode, num_slots sentences at a time) vs continuous batching
+    model.eval()
+    sos_idx, eos_idx, pad_idx = (tokenizer_src.token_to_id(t) for t in ('[SOS]', '[EOS]', '[PAD]'))
+    start = time.perf_counter()
+    static = []
+    with torch.no_grad():
+        for i in range(0, len(sentences), num_slots):
+            chunk = [torch.tensor([sos_idx] + tokenizer_src.encode(text).ids[: max_len - 2] + [eos_idx]) for text in sentences[i : i + num_slots]]
+            source = pad_sequence(chunk, batch_first = True, padding_value = pad_idx).to(device)
+            lengths = torch.tensor([len(c) for c in chunk], device = device)
+            out = batched_greedy_decode(model, source, None, tokenizer_tgt, max_len, device, source_lengths = lengths)
+            static.extend(tokenizer_tgt.decode_batch([strip_padding(row, tokenizer_tgt) for row in out.tolist()]))
+    static_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    continuous, scheduler = translate_continuous(model, sentences, tokenizer_src, tokenizer_tgt, max_len, device, num_slots)
+    continuous_time = time.perf_counter() - start
+
+    same = sum(a == b for a, b in zip(static, continuous))
+    print(f"static batches : {len(sentences) / static_time:8.1f} sentences/s")
+    print(f"continuous     : {len(sentences) / continuous_time:8.1f} sentences/s, slot utilization {scheduler.slot_utilization():.2f}")
+    print(f"identical translations: {same} / {len(sentences)}")
+    return {"static_per_sec": len(sentences) / static_time, "continuous_per_sec": len(sentences) / continuous_time,
+            "slot_utilization": scheduler.slot_utilization(), "identical": same}
+
+# benchmark_continuous_batching(model, [val_dataloader.dataset[i]['src_text'] for i in range(200)], tokenizer_src, tokenizer_tgt, cfg['seq_len'], device)
+
+
+## two level cache for repeated source sentences, keyed by the source token ids (so spacing differences the tokenizer drops
+## still hit) and by the fingerprint of the model weights, a new checkpoint never serves old results:
+## level 1 - final translations, keyed by source ids + decoding method and parameters
+## level 2 - encoder_output tensors, keyed by source ids only, shared by every decoding setting
+## both levels evict least recently used entries once their size in bytes goes over the limit
+import hashlib
+import io
+from collections import OrderedDict
+
+class ByteLRUCache:
+    def __init__(self, max_bytes:int, size_fn):
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+        self.entries = OrderedDict() # key -> (value, bytes), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        if size > self.max_bytes:
+            return # would evict everything else and still not fit
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last = False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / max(self.hits + self.misses, 1)}
+
+
+def model_fingerprint(model):
+    ## sha256 over the state dict, names and raw bytes of every tensor
+    h = hashlib.sha256()
+    for name, value in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        if torch.is_tensor(value) and not value.is_quantized:
+            h.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            ## packed / quantized parameters of a quantize_for_cpu model
+            buffer = io.BytesIO()
+            torch.save(value, buffer)
+            h.update(buffer.getvalue())
+    return h.hexdigest()[:16]
+
+
+class TranslationCache:
+    def __init__(self, model, tokenizer_src, tokenizer_tgt, device, max_len:int, translation_bytes:int = 16 * 2**20,
+                 encoder_bytes:int = 256 * 2**20, fingerprint:str = None):
+        self.tokenizer_src = tokenizer_src
+        self.tokenizer_tgt = tokenizer_tgt
+        self.device = device
+        self.max_len = max_len
+        self.translations = ByteLRUCache(translation_bytes, lambda text: len(text.encode()) + 100) # + key and bookkeeping
+        self.encoder_outputs = ByteLRUCache(encoder_bytes, lambda t: t.numel() * t.element_size())
+        self.set_model(model, fingerprint)
+
+    def set_model(self, model, fingerprint:str = None):
+        ## a model with different weights (new checkpoint) drops both levels, fingerprint can be given (e.g. file_hash of the checkpoint)
+        fingerprint = fingerprint or model_fingerprint(model)
+        if fingerprint != getattr(self, 'fingerprint', None):
+            self.translations.clear()
+            self.encoder_outputs.clear()
+        self.model = model.eval()
+        self.fingerprint = fingerprint
+
+    def source_ids(self, text:str):
+        sos, eos = self.tokenizer_src.token_to_id('[SOS]'), self.tokenizer_src.token_to_id('[EOS]')
+        return tuple([sos] + self.tokenizer_src.encode(text).ids[: self.max_len - 2] + [eos])
+
+    def encode(self, ids):
+        key = (self.fingerprint, ids)
+        encoder_output = self.encoder_outputs.get(key)
+        if encoder_output is None:
+            source = torch.tensor([ids], dtype = torch.int64, device = self.device)
+            encoder_output = self.model.encode(source) # [1, seq_len, d_model], one unpadded sentence needs no mask
+            self.encoder_outputs.put(key, encoder_output)
+        return encoder_output
+
+    def translate(self, text:str, method:str = "greedy", **params):
+        ## method "greedy" (batched_greedy_decode) or "beam" (beam_search_decode with params beam_size, length_penalty)
+        ids = self.source_ids(text)
+        key = (self.fingerprint, ids, method, tuple(sorted(params.items())))
+        translation = self.translations.get(key)
+        if translation is not None:
+            return translation
+        with torch.no_grad():
+            encoder_output = self.encode(ids)
+            source = torch.tensor([ids], dtype = torch.int64, device = self.device)
+            if method == "greedy":
+                out = batched_greedy_decode(self.model, source, None, self.tokenizer_tgt, self.max_len, self.device, encoder_output = encoder_output, **params)
+            elif method == "beam":
+                out, _ = beam_search_decode(self.model, source, None, self.tokenizer_tgt, self.max_len, self.device, encoder_output = encoder_output, **params)
+            else:
+                raise ValueError(f"unknown decoding method {method}")
+        translation = self.tokenizer_tgt.decode(strip_padding(out[0].tolist(), self.tokenizer_tgt))
+        self.translations.put(key, translation)
+        return translation
+
+    def stats(self):
+        return {"fingerprint": self.fingerprint, "translations": self.translations.stats(), "encoder_outputs": self.encoder_outputs.stats()}
+
+# translation_cache = TranslationCache(model, tokenizer_src, tokenizer_tgt, device, cfg['seq_len'])
+# translation_cache.translate("I am not a very good a student."), translation_cache.translate("I am not a very good a student.", "beam", beam_size = 4)
+# print(translation_cache.stats())
+
+
+def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples= 2, max_batches = None, shortlist = None):
+    ## validation_ds yields padded batches (see Collator), every sentence of every batch is decoded and scored
+    ## num_examples is only the number of sentences printed, max_batches = None scores the full validation split
+    model.eval()
 
     try:
         # get the console window width
@@ -515,35 +1756,16 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
         # if we cant get the console width
         console_width = 80
 
-    with torch.no_grad():
-        for batch in validation_ds:
-            count += 1
-            encoder_input = batch['encoder_input'].to(device) # [B, seq_len]
-            encoder_mask = batch['encoder_mask'].to(device) # [B, 1, 1, seq_len]
-
-            ## check that the batch size is 1
-            assert encoder_input.size(0) == 1, "batch size must be 1 for validation"
+    ## shortlist (get_or_build_shortlist) decodes over a per sentence vocabulary shortlist, see translate_dataset
+    source_texts, expected, predicted = translate_dataset(model, validation_ds, tokenizer_tgt, max_len, device, max_batches, shortlist)
 
-            model_out = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
-
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
-
-            source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-
-            ## print the sourc , target and model output
-
-            print_msg('-'* console_width)
-            print_msg(f"{f'SOURCE: ':>12}{source_text}")
-            print_msg(f"{f'TARGET: ':>12}{target_text}")
-            print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
-
-            if count == num_examples:
-                print_msg('-'*console_width)
-                break
+    ## print the source , target and model output of the first few sentences
+    for source_text, target_text, model_out_text in list(zip(source_texts, expected, predicted))[:num_examples]:
+        print_msg('-'* console_width)
+        print_msg(f"{f'SOURCE: ':>12}{source_text}")
+        print_msg(f"{f'TARGET: ':>12}{target_text}")
+        print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
+    print_msg('-'*console_width)
     if writer:
         ## evaluate the character error rate
         ## compute the char error rate
@@ -576,12 +1798,324 @@ def get_or_build_tokenizer(config, ds, lang):
         tokenizer.pre_tokenizer = Whitespace()
         trainer = WordLevelTrainer(special_tokens=["[UNK]","[PAD]","[SOS]","[EOS]"], min_frequency = 2)
         ## for a word to be a part of our dataset, it should atleast come twice otherwise its not the part of our dataset
-        tokenizer.train_from_iterator(get_all_sentences(ds, lang), trainer = trainer)
+        ## chunks of sentences instead of one at a time, the word counting in the trainer then runs on all cores
+        tokenizer.train_from_iterator(iter_sentence_chunks(ds, lang), trainer = trainer, length = len(ds))
         tokenizer.save(str(tokenizer_path))
     else:
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer
 
+
+## corpus scale tokenization: encode_batch over chunks of sentences instead of one encode() per sentence, optionally fanned out
+## over a process pool, results come back as NumPy arrays (flat int32 ids + lengths) chunk by chunk, in corpus order
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
+
+TOKENIZE_CHUNK_SIZE = 10000
+
+def iter_sentence_chunks(ds, lang, chunk_size:int = TOKENIZE_CHUNK_SIZE):
+    ## lists of up to chunk_size sentences of ds (anything yielding {'translation': {...}} items)
+    chunk = []
+    for sentence in get_all_sentences(ds, lang):
+        chunk.append(sentence)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _encode_chunk(tokenizer, sentences):
+    encodings = tokenizer.encode_batch(sentences)
+    lengths = np.fromiter((len(e.ids) for e in encodings), dtype = np.int64, count = len(encodings))
+    ids = np.fromiter(itertools.chain.from_iterable(e.ids for e in encodings), dtype = np.int32, count = int(lengths.sum()))
+    return ids, lengths
+
+
+## worker processes get the tokenizer once, as its JSON, instead of with every chunk
+_worker_tokenizer = None
+
+def _init_tokenize_worker(tokenizer_json):
+    global _worker_tokenizer
+    ## every worker is one process of the pool, the tokenizers thread pool inside a forked process is not safe
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = Tokenizer.from_str(tokenizer_json)
+
+
+def _encode_chunk_in_worker(sentences):
+    return _encode_chunk(_worker_tokenizer, sentences)
+
+
+def iter_encoded_chunks(tokenizer, sentence_chunks, num_workers:int = 0):
+    ## yields (ids [n_tokens] int32, lengths [n_sentences] int64) per chunk of sentence_chunks, in order
+    ## num_workers = 0 encodes in this process (encode_batch itself already uses the tokenizers thread pool)
+    if num_workers == 0:
+        for sentences in sentence_chunks:
+            yield _encode_chunk(tokenizer, sentences)
+        return
+    ## fork so the workers do not re-run this script
+    with ProcessPoolExecutor(num_workers, mp_context = multiprocessing.get_context("fork"),
+                             initializer = _init_tokenize_worker, initargs = (tokenizer.to_str(),)) as pool:
+        yield from pool.map(_encode_chunk_in_worker, sentence_chunks)
+
+
+def encode_corpus(tokenizer, sentences, num_workers:int = 0, chunk_size:int = TOKENIZE_CHUNK_SIZE):
+    ## whole corpus as flat ids [n_tokens] int32 and offsets [n_sentences + 1] int64, sentence i is ids[offsets[i] : offsets[i + 1]]
+    chunks = (sentences[i : i + chunk_size] for i in range(0, len(sentences), chunk_size))
+    all_ids, all_lengths = [], []
+    for ids, lengths in iter_encoded_chunks(tokenizer, chunks, num_workers):
+        all_ids.append(ids)
+        all_lengths.append(lengths)
+    lengths = np.concatenate(all_lengths) if all_lengths else np.zeros(0, dtype = np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    ids = np.concatenate(all_ids) if all_ids else np.zeros(0, dtype = np.int32)
+    return ids, offsets
+
+
+def benchmark_tokenization(tokenizer, sentences, workers = (0, 1, 2, 4, 8), chunk_size:int = TOKENIZE_CHUNK_SIZE):
+    ## sentences / second of one encode() per sentence against encode_corpus with a growing process pool
+    results = {}
+    start = time.perf_counter()
+    for sentence in sentences:
+        tokenizer.encode(sentence).ids
+    results["encode"] = len(sentences) / (time.perf_counter() - start)
+    print(f"{'encode() loop':>20} : {results['encode']:12.0f} sentences/s")
+    for num_workers in workers:
+        start = time.perf_counter()
+        encode_corpus(tokenizer, sentences, num_workers, chunk_size)
+        results[num_workers] = len(sentences) / (time.perf_counter() - start)
+        print(f"{f'{num_workers} workers':>20} : {results[num_workers]:12.0f} sentences/s")
+    return results
+
+# benchmark_tokenization(tokenizer_src, list(get_all_sentences(load_dataset('opus_books', f"{cfg['lang_src']}-{cfg['lang_tgt']}", split = 'train'), cfg['lang_src'])))
+
+
+
+import hashlib
+import json
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+## token ids of a whole corpus stored as flat int32 arrays + offsets, one .npy file per array, memory mapped with numpy
+## sentence i of the source side is src_ids[src_offsets[i] : src_offsets[i + 1]]
+class TokenCache:
+    FIELDS = ("src_ids", "src_offsets", "tgt_ids", "tgt_offsets", "src_chars", "tgt_chars", "index")
+
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        for field in self.FIELDS:
+            setattr(self, field, np.load(f"{self.prefix}_{field}.npy", mmap_mode = 'r'))
+
+    ## pickle only the file prefix, DataLoader workers re-open the memory map instead of receiving a copy of the arrays
+    def __getstate__(self):
+        return {"prefix": self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state["prefix"])
+
+    def __len__(self):
+        return len(self.index)
+
+    def src(self, row):
+        return self.src_ids[self.src_offsets[row] : self.src_offsets[row + 1]]
+
+    def tgt(self, row):
+        return self.tgt_ids[self.tgt_offsets[row] : self.tgt_offsets[row + 1]]
+
+    def src_lengths(self):
+        return np.diff(self.src_offsets)
+
+    def tgt_lengths(self):
+        return np.diff(self.tgt_offsets)
+
+    @staticmethod
+    def exists(prefix):
+        return all(Path(f"{prefix}_{field}.npy").exists() for field in TokenCache.FIELDS)
+
+    @staticmethod
+    def write(prefix, arrays):
+        ## write to a temporary name and rename, so an interrupted run never leaves a half written cache behind
+        ## "index" is written last, TokenCache.exists only returns True once every file is complete
+        for field in sorted(TokenCache.FIELDS, key = lambda f: f == "index"):
+            tmp_path = f"{prefix}_{field}.npy.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arrays[field])
+            os.replace(tmp_path, f"{prefix}_{field}.npy")
+
+
+def get_or_build_token_cache(config, ds, tokenizer_src, tokenizer_tgt, max_tokens = None):
+    ## tokenizes every pair of ds once and stores it as a TokenCache
+    ## pairs longer than max_tokens (without [SOS]/[EOS]) are left out, "index" maps cache rows back to rows of ds
+    ## the file name is keyed by the tokenizer files and the filter settings, so a retrained tokenizer never reads stale ids
+    key = json.dumps({
+        "tokenizer_src": file_hash(config['tokenizer_file'].format(config['lang_src'])),
+        "tokenizer_tgt": file_hash(config['tokenizer_file'].format(config['lang_tgt'])),
+        "pair": f"{config['lang_src']}-{config['lang_tgt']}",
+        "num_rows": len(ds),
+        "max_tokens": max_tokens,
+    }, sort_keys = True)
+    cache_dir = Path(config['token_cache_dir'])
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    prefix = cache_dir / f"{config['lang_src']}-{config['lang_tgt']}_{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+    if not TokenCache.exists(prefix):
+        ## both sides encoded in chunks (config['tokenize_workers'] processes), the length filter is applied on the arrays
+        src_texts = list(get_all_sentences(ds, config['lang_src']))
+        tgt_texts = list(get_all_sentences(ds, config['lang_tgt']))
+        workers = config.get('tokenize_workers', 0)
+        src_ids, src_offsets = encode_corpus(tokenizer_src, src_texts, workers)
+        tgt_ids, tgt_offsets = encode_corpus(tokenizer_tgt, tgt_texts, workers)
+        src_lengths, tgt_lengths = np.diff(src_offsets), np.diff(tgt_offsets)
+
+        keep = np.ones(len(src_texts), dtype = bool)
+        if max_tokens is not None:
+            keep = (src_lengths <= max_tokens) & (tgt_lengths <= max_tokens)
+        def kept(ids, lengths):
+            ## drop the tokens of the filtered pairs and rebuild the offsets
+            return ids[np.repeat(keep, lengths)], np.concatenate([[0], np.cumsum(lengths[keep])]).astype(np.int64)
+        src_ids, src_offsets = kept(src_ids, src_lengths)
+        tgt_ids, tgt_offsets = kept(tgt_ids, tgt_lengths)
+
+        TokenCache.write(prefix, {
+            "src_ids": src_ids,
+            "src_offsets": src_offsets,
+            "tgt_ids": tgt_ids,
+            "tgt_offsets": tgt_offsets,
+            "src_chars": np.asarray([len(t) for t in src_texts], dtype = np.int32)[keep],
+            "tgt_chars": np.asarray([len(t) for t in tgt_texts], dtype = np.int32)[keep],
+            "index": np.nonzero(keep)[0].astype(np.int64),
+        })
+
+    return TokenCache(prefix)
+
+
+def build_shortlist(token_cache, rows, src_vocab_size:int, tokenizer_tgt, top_n:int = 50, num_frequent:int = 1000, chunk_size:int = 10000):
+    ## vocabulary shortlist from source/target co-occurrence on the training pairs (rows of the token cache):
+    ## table[s] holds the top_n target ids that appear most often in the same pair as source id s (-1 if fewer),
+    ## always holds the num_frequent most frequent target ids plus the special tokens, they are candidates for every sentence
+    tgt_vocab_size = tokenizer_tgt.get_vocab_size()
+    chunk_keys, chunk_counts = [], []
+    for start in range(0, len(rows), chunk_size):
+        keys = []
+        for row in rows[start : start + chunk_size]:
+            src = np.unique(token_cache.src(row)).astype(np.int64)
+            tgt = np.unique(token_cache.tgt(row)).astype(np.int64)
+            keys.append((src[:, None] * tgt_vocab_size + tgt[None, :]).ravel()) # every (source id, target id) pair once per sentence
+        if keys:
+            k, c = np.unique(np.concatenate(keys), return_counts = True)
+            chunk_keys.append(k)
+            chunk_counts.append(c)
+    keys, inverse = np.unique(np.concatenate(chunk_keys), return_inverse = True)
+    counts = np.bincount(inverse, weights = np.concatenate(chunk_counts))
+
+    ## sort by source id, then by decreasing count, and keep the first top_n of every source id
+    src_ids, tgt_ids = keys // tgt_vocab_size, keys % tgt_vocab_size
+    order = np.lexsort((-counts, src_ids))
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    rank = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids, side = 'left')
+    keep = rank < top_n
+    table = np.full((src_vocab_size, top_n), -1, dtype = np.int64)
+    table[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+    tgt_frequency = np.bincount(np.concatenate([token_cache.tgt(row) for row in rows]), minlength = tgt_vocab_size)
+    special = [tokenizer_tgt.token_to_id(t) for t in ("[UNK]", "[PAD]", "[SOS]", "[EOS]")]
+    always = np.unique(np.concatenate([special, np.argsort(-tgt_frequency, kind = 'stable')[:num_frequent]]))
+    return {"table": torch.from_numpy(table), "always": torch.from_numpy(always.astype(np.int64))}
+
+
+def get_or_build_shortlist(token_cache, rows, src_vocab_size:int, tokenizer_tgt, top_n:int = 50, num_frequent:int = 1000):
+    ## stored next to the token cache, keyed by the training rows and the shortlist settings
+    rows = np.asarray(rows, dtype = np.int64)
+    key = hashlib.sha256(rows.tobytes() + f"{top_n}-{num_frequent}".encode()).hexdigest()[:16]
+    path = f"{token_cache.prefix}_shortlist_{key}.npz"
+    if not Path(path).exists():
+        shortlist = build_shortlist(token_cache, rows, src_vocab_size, tokenizer_tgt, top_n, num_frequent)
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, table = shortlist["table"].numpy(), always = shortlist["always"].numpy())
+        os.replace(path + ".tmp", path)
+    data = np.load(path)
+    return {"table": torch.from_numpy(data["table"]), "always": torch.from_numpy(data["always"])}
+
+
+def shortlist_candidates(shortlist, source, source_lengths):
+    ## candidate target ids [B, C] of every sentence of source [B, S]: the union of the table rows of its tokens and "always"
+    ## rows are padded with a repeated id, a duplicate candidate does not change the argmax
+    table = shortlist["table"].to(source.device)
+    always = shortlist["always"].to(source.device)
+    candidates = table[source] # [B, S, top_n]
+    padding = torch.arange(source.size(1), device = source.device) >= source_lengths.unsqueeze(1)
+    candidates = candidates.masked_fill(padding.unsqueeze(-1), -1)
+    rows = []
+    for row in candidates:
+        ids = torch.cat([always, row.flatten()])
+        rows.append(torch.unique(ids[ids >= 0]))
+    return pad_sequence(rows, batch_first = True, padding_value = int(always[0]))
+
+
+def keep_pair(src_chars, tgt_chars):
+    ## character length filter for the training pairs, works on ints and on numpy arrays
+    return (src_chars < 150) & (src_chars > 3) & (tgt_chars < 150) & (tgt_chars > 3) & (src_chars + 10 > tgt_chars)
+
+
+def get_train_dataloader(config, train_ds, collate):
+    ## config['max_batch_tokens'] switches from fixed batch_size batches to length bucketed batches with a token budget
+    ## config['world_size'] / config['rank'] (set by train_model) shard the batches between data parallel workers
+    world_size, rank = config.get('world_size', 1), config.get('rank', 0)
+    if config.get('max_batch_tokens'):
+        batch_sampler = TokenBudgetBatchSampler(train_ds.lengths(), config['max_batch_tokens'], config.get('bucket_width', 8),
+                                                seed = config.get('seed', 0), num_replicas = world_size, rank = rank)
+        efficiency = batch_sampler.padding_efficiency()
+        print(f"padding efficiency of the training batches: source {efficiency['source']:.3f}, target {efficiency['target']:.3f}, "
+              f"combined {efficiency['combined']:.3f}")
+        return DataLoader(train_ds, batch_sampler = batch_sampler, collate_fn = collate)
+    ## the shuffle is seeded with config['seed'] + epoch (Trainer.train_epoch calls set_epoch), so a resumed run sees the
+    ## same batch order; with world_size 1 the DistributedSampler is only a seeded shuffle over the whole dataset
+    sampler = DistributedSampler(train_ds, num_replicas = world_size, rank = rank, shuffle = True, seed = config.get('seed', 0), drop_last = world_size > 1)
+    return DataLoader(train_ds, batch_size = config['batch_size'], sampler = sampler, collate_fn = collate)
+
+
+def get_ds_from_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt):
+    ## same split, filtering and sorting as get_ds but on the pre-tokenized cache, the tokenizers are not run at all after the first time
+    ## [SOS] and [EOS] are added to the source, so a source can only be seq_len - 2 tokens long
+    token_cache = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt, max_tokens = config['seq_len'] - 2)
+
+    ## keep 90% for traning and 10% for validation, seeded so that a resumed run (and every data parallel rank) gets the same split
+    rows = np.random.default_rng(config.get('seed', 0)).permutation(len(token_cache))
+    train_ds_size = int(0.9 * len(rows))
+    train_rows, val_rows = rows[:train_ds_size], rows[train_ds_size:]
+
+    src_chars = np.asarray(token_cache.src_chars)
+    tgt_chars = np.asarray(token_cache.tgt_chars)
+    train_rows = train_rows[keep_pair(src_chars[train_rows], tgt_chars[train_rows])]
+    train_rows = train_rows[np.argsort(src_chars[train_rows], kind = 'stable')]
+
+    train_ds = TokenizedBillingualDataset(token_cache, train_rows, ds_raw, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    val_ds = TokenizedBillingualDataset(token_cache, val_rows, ds_raw, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+
+    ## max lengths straight from the offsets
+    src_lengths = token_cache.src_lengths()
+    tgt_lengths = token_cache.tgt_lengths()
+    print(f'Max length of source sentence: {src_lengths.max()}')
+    print(f'Max length of target sentence: {tgt_lengths.max()}')
+    print(f'Max length of filtered source sentence: {src_lengths[train_rows].max()}')
+    print(f'Max length of filterd target sentence: {tgt_lengths[train_rows].max()}')
+
+    print("length of train dataset" , len(train_ds))
+    print("length of validation dataset" , len(val_ds))
+
+    collate = Collator(tokenizer_src.token_to_id('[PAD]'), tokenizer_tgt.token_to_id('[PAD]'))
+    train_dataloader = get_train_dataloader(config, train_ds, collate)
+    val_dataloader = DataLoader(val_ds, batch_size = config.get('val_batch_size', 64), shuffle = False, collate_fn = collate)
+
+    return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
+
 def get_ds(config):
     # it has only the train split, so we divide it ourselves
     ds_raw = load_dataset('opus_books', f"{config['lang_src']}-{config['lang_tgt']}", split = 'train')
@@ -591,44 +2125,51 @@ def get_ds(config):
     tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
     tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
 
-
+    ## with a token cache directory configured the corpus is tokenized once and memory mapped afterwards
+    if config.get('token_cache_dir'):
+        return get_ds_from_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt)
 
 
     ## keep 90% for traning and 10% for validation
     train_ds_size = int(0.9 * len(ds_raw))
     val_ds_size = len(ds_raw) - train_ds_size
 
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
+    ## seeded, so that a resumed run (and every data parallel rank) gets the same split
+    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size], generator = torch.Generator().manual_seed(config.get('seed', 0)))
     sorted_train_ds = sorted(train_ds_raw, key = lambda x:len(x["translation"][config['lang_src']]))
     # sorted_train_ds = train_ds_raw ## not sorted, taken as it is
-    filtered_sorted_train_ds = [k for k in sorted_train_ds if (len(k['translation'][config['lang_src']]) < 150 and  len(k['translation'][config['lang_src']]) > 3)]
-    filtered_sorted_train_ds = [k for k in filtered_sorted_train_ds if (len(k['translation'][config['lang_tgt']]) < 150 and len(k['translation'][config['lang_tgt']]) > 3)]
-    filtered_sorted_train_ds = [k for k in filtered_sorted_train_ds if len(k['translation'][config['lang_src']]) + 10 > len(k['translation'][config['lang_tgt']]) ]
+    filtered_sorted_train_ds = [k for k in sorted_train_ds if keep_pair(len(k['translation'][config['lang_src']]), len(k['translation'][config['lang_tgt']]))]
+
+    workers = config.get('tokenize_workers', 0)
+    def token_lengths(ds, lang, tokenizer):
+        _, offsets = encode_corpus(tokenizer, list(get_all_sentences(ds, lang)), workers)
+        return np.diff(offsets)
 
+    def fit_seq_len(ds):
+        ## same filter as the token cache path: at most seq_len - 2 tokens on both sides ([SOS] and [EOS] are added),
+        ## BillingualDataset raises on longer pairs and the validation walks the whole split
+        ds = list(ds)
+        keep = (token_lengths(ds, config['lang_src'], tokenizer_src) <= config['seq_len'] - 2) & \
+               (token_lengths(ds, config['lang_tgt'], tokenizer_tgt) <= config['seq_len'] - 2)
+        return [item for item, k in zip(ds, keep) if k]
+
+    filtered_sorted_train_ds = fit_seq_len(filtered_sorted_train_ds)
+    filtered_val_ds = fit_seq_len(val_ds_raw)
 
     train_ds = BillingualDataset(filtered_sorted_train_ds, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
     # train_ds = BillingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-    val_ds = BillingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    val_ds = BillingualDataset(filtered_val_ds, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
 
 
     # find max length of each sentence in the source and target sentence
-    max_len_src = 0
-    max_len_tgt = 0
-
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    def max_length(ds, lang, tokenizer):
+        return int(token_lengths(ds, lang, tokenizer).max(initial = 0))
 
+    max_len_src = max_length(ds_raw, config['lang_src'], tokenizer_src)
+    max_len_tgt = max_length(ds_raw, config['lang_tgt'], tokenizer_tgt)
 
-    max_len_src_filtered = 0
-    max_len_tgt_filtered = 0
-    for item in filtered_sorted_train_ds:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src_filtered = max(max_len_src_filtered, len(src_ids))
-        max_len_tgt_filtered = max(max_len_tgt_filtered, len(tgt_ids))
+    max_len_src_filtered = max_length(filtered_sorted_train_ds, config['lang_src'], tokenizer_src)
+    max_len_tgt_filtered = max_length(filtered_sorted_train_ds, config['lang_tgt'], tokenizer_tgt)
 
 
     print(f'Max length of source sentence: {max_len_src}')
@@ -640,8 +2181,9 @@ def get_ds(config):
     print("length of train dataset" , len(train_ds))
     print("length of validation dataset" , len(val_ds))
 
-    train_dataloader = DataLoader(train_ds, batch_size = config['batch_size'], shuffle = True, collate_fn = collate_fn )
-    val_dataloader = DataLoader(val_ds, batch_size = 1, shuffle = True)
+    collate = Collator(tokenizer_src.token_to_id('[PAD]'), tokenizer_tgt.token_to_id('[PAD]'))
+    train_dataloader = get_train_dataloader(config, train_ds, collate)
+    val_dataloader = DataLoader(val_ds, batch_size = config.get('val_batch_size', 64), shuffle = False, collate_fn = collate)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
@@ -718,166 +2260,1095 @@ def collate_fn(batch):
     }
 
 
-def get_model(config, vocab_src_len, vocab_tgt_len):
-    model = build_transformer(vocab_src_len, vocab_tgt_len, config['seq_len'], config['seq_len'], d_model = config['d_model'])
-    return model
+from torch.nn.utils.rnn import pad_sequence
 
-# from config import get_config
+## vectorized replacement of collate_fn. The pad ids are bound when it is created (no module level tokenizers), so it can be
+## pickled into DataLoader workers. It pads every sequence in one call and returns the sequence lengths instead of
+## per sample masks, attention builds the masks from the lengths (MultiHeadAttentionBlock.build_mask)
+class Collator:
+    def __init__(self, pad_id_src:int, pad_id_tgt:int):
+        self.pad_id_src = pad_id_src
+        self.pad_id_tgt = pad_id_tgt
 
-cfg = get_config()
-cfg['batch_size'] = 8
-cfg['preload'] = None
-cfg['num_epochs'] = 10
+    def __call__(self, batch):
+        return {
+            "encoder_input": pad_sequence([b['encoder_input'] for b in batch], batch_first = True, padding_value = self.pad_id_src), # [B, S_enc]
+            "decoder_input": pad_sequence([b['decoder_input'] for b in batch], batch_first = True, padding_value = self.pad_id_tgt), # [B, S_dec]
+            "label": pad_sequence([b['label'] for b in batch], batch_first = True, padding_value = self.pad_id_tgt), # [B, S_dec]
+            "encoder_length": torch.tensor([len(b['encoder_input']) for b in batch], dtype = torch.int64), # [B]
+            "decoder_length": torch.tensor([len(b['decoder_input']) for b in batch], dtype = torch.int64), # [B]
+            "src_text": [b["src_text"] for b in batch],
+            "tgt_text": [b["tgt_text"] for b in batch],
+        }
 
-# from train import train_model
 
-torch.cuda.amp.autocast(enabled=True)
-## in pytorch lightening, check if the above command is already enabled when precision is set to FP16
+def length_masks(encoder_length, decoder_length, encoder_seq_len:int, decoder_seq_len:int):
+    ## the same dense masks as collate_fn, built by broadcasting the lengths on their own device
+    ## only the reference for check_length_masks, the model takes the lengths directly
+    ## encoder mask [B, 1, 1, S_enc], decoder mask (padding & causal) [B, 1, S_dec, S_dec]
+    device = encoder_length.device
+    encoder_mask = torch.arange(encoder_seq_len, device = device) < encoder_length.unsqueeze(1)
+    decoder_mask = torch.arange(decoder_seq_len, device = device) < decoder_length.unsqueeze(1)
+    causal = torch.ones(decoder_seq_len, decoder_seq_len, dtype = torch.bool, device = device).tril()
+    return encoder_mask[:, None, None, :].int(), (decoder_mask[:, None, None, :] & causal).int()
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print("Using device: ", device)
 
-## make sure the weights folder exists
-Path(cfg['model_folder']).mkdir(parents = True, exist_ok = True)
+def check_length_masks(batch_sizes = (3, 8, 16), seq_len:int = 12, d_model:int = 64, h:int = 8, beam:int = 3, atol = 1e-6):
+    ## attention with masks built from lengths must match attention with the dense length_masks masks, for batch sizes
+    ## different from h and with the extra beam dimension of beam_search_decode ([batch, beam] lengths)
+    torch.manual_seed(0)
+    attention = MultiHeadAttentionBlock(d_model, h, 0.0).eval()
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            lengths = torch.randint(1, seq_len + 1, (batch_size,))
+            lengths[0] = seq_len
+            encoder_mask, decoder_mask = length_masks(lengths, lengths, seq_len, seq_len)
+            x = torch.randn(batch_size, seq_len, d_model)
+
+            dense = attention(x, x, x, encoder_mask)
+            assert torch.allclose(attention(x, x, x, None, key_lengths = lengths), dense, atol = atol), f"padding mask differs, batch {batch_size}"
+            dense_causal = attention(x, x, x, decoder_mask)
+            assert torch.allclose(attention(x, x, x, None, key_lengths = lengths, is_causal = True), dense_causal, atol = atol), f"causal mask differs, batch {batch_size}"
+
+            x_beam = x.unsqueeze(1).expand(batch_size, beam, seq_len, d_model)
+            out_beam = attention(x_beam, x_beam, x_beam, None, key_lengths = lengths.unsqueeze(1))
+            assert torch.allclose(out_beam, dense.unsqueeze(1).expand_as(out_beam), atol = atol), f"beam padding mask differs, batch {batch_size}"
+    print("length masks match the dense masks")
 
-train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(cfg)
+# check_length_masks()
 
 
-model = get_model(cfg, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+def benchmark_collate(dataset, collate, batch_sizes = (8, 32, 128), repeats = 20):
+    ## time per collated batch in milliseconds, with a vectorized collate it should grow much slower than the batch size
+    results = {}
+    for batch_size in batch_sizes:
+        samples = [dataset[i % len(dataset)] for i in range(batch_size)]
+        collate(samples) # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            collate(samples)
+        results[batch_size] = (time.perf_counter() - start) / repeats * 1000
+        print(f"batch_size = {batch_size:4d} : {results[batch_size]:8.3f} ms per batch, {results[batch_size] / batch_size * 1000:8.2f} us per sample")
+    return results
 
-# tensorboard
-writer = SummaryWriter(cfg['experiment_name'])
+# benchmark_collate(train_dataloader.dataset, train_dataloader.collate_fn)
 
-optimizer = torch.optim.Adam(model.parameters(), lr = cfg['lr'] , eps = 1e-9)
-## each feature can have different learnign rate, so for words seen less it can increase learning rate of those weights
+
+def get_model(config, vocab_src_len, vocab_tgt_len):
+    model = build_transformer(vocab_src_len, vocab_tgt_len, config['seq_len'], config['seq_len'], d_model = config['d_model'], attention_backend = config.get('attention_backend', 'math'),
+                              encoder_sharing = config.get('encoder_sharing', 'mirrored'), decoder_sharing = config.get('decoder_sharing', 'mirrored'),
+                              num_unique_blocks = config.get('num_unique_blocks'), fused_qkv = config.get('fused_qkv', False),
+                              fused_norm = config.get('fused_norm', False))
+    ## activation checkpointing of every k-th layer position or of an explicit list of positions
+    set_activation_checkpointing(model, config.get('checkpoint_layers'), config.get('checkpoint_every'))
+    return model
+
+import copy
+import io
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+def quantize_for_cpu(model, quantize_embeddings:bool = False):
+    ## dynamic int8 quantization for CPU inference: the weights of every nn.Linear (w_q/w_k/w_v/w_o, linear_1/linear_2 and
+    ## the projection) are stored in int8 and the activations are quantized on the fly
+    ## quantize_embeddings also stores the embedding tables in 8 bit (weight only)
+    ## the model is copied first, the shared mirrored blocks stay shared in the copy
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig}
+    if quantize_embeddings:
+        qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+    model = copy.deepcopy(model).cpu().eval()
+    return quantize_dynamic(model, qconfig_spec, dtype = torch.qint8)
+
+
+def save_quantized_checkpoint(qmodel, path, config, vocab_src_len, vocab_tgt_len, quantize_embeddings:bool = False):
+    ## the quantized state dict plus everything needed to rebuild the same module structure on load
+    torch.save({
+        'quantized': True,
+        'quantize_embeddings': quantize_embeddings,
+        'config': config,
+        'vocab_src_len': vocab_src_len,
+        'vocab_tgt_len': vocab_tgt_len,
+        'model_state_dict': qmodel.state_dict(),
+    }, path)
+
+
+def load_quantized_checkpoint(path):
+    state = torch.load(path, map_location = 'cpu')
+    assert state.get('quantized'), f"{path} is not a quantized checkpoint"
+    model = get_model(state['config'], state['vocab_src_len'], state['vocab_tgt_len'])
+    qmodel = quantize_for_cpu(model, state['quantize_embeddings'])
+    qmodel.load_state_dict(state['model_state_dict'])
+    return qmodel
+
+
+def serialized_size(model):
+    ## bytes of the saved state dict, what a checkpoint of the model costs on disk and to load
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def compare_quantized_model(model, qmodel, val_dataloader, tokenizer_tgt, max_len, max_batches = None):
+    ## runs the fp32 and the int8 model over the validation split on CPU and reports latency, size, BLEU and CER of both
+    results = {}
+    for name, m in (("fp32", copy.deepcopy(model).cpu().eval()), ("int8", qmodel)):
+        start = time.perf_counter()
+        _, expected, predicted = translate_dataset(m, val_dataloader, tokenizer_tgt, max_len, torch.device('cpu'), max_batches)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "ms_per_sentence": elapsed / max(len(predicted), 1) * 1000,
+            "size_mb": serialized_size(m) / 2**20,
+            "bleu": float(torchmetrics.BLEUScore()(predicted, expected)),
+            "cer": float(torchmetrics.CharErrorRate()(predicted, expected)),
+        }
+        print(f"{name}: {results[name]['ms_per_sentence']:8.2f} ms/sentence, {results[name]['size_mb']:8.1f} MB, "
+              f"BLEU {results[name]['bleu']:.4f}, CER {results[name]['cer']:.4f}")
+    print(f"int8 - fp32: BLEU {results['int8']['bleu'] - results['fp32']['bleu']:+.4f}, CER {results['int8']['cer'] - results['fp32']['cer']:+.4f}, "
+          f"speedup {results['fp32']['ms_per_sentence'] / results['int8']['ms_per_sentence']:.2f}x")
+    return results
+
+# qmodel = quantize_for_cpu(model)
+# compare_quantized_model(model, qmodel, val_dataloader, tokenizer_tgt, cfg['seq_len'])
+# save_quantized_checkpoint(qmodel, get_weights_file_path(cfg, "int8"), cfg, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+
+import contextlib
 
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
 
-MAX_LR = 10**-3
-STEPS_PER_EPOCH = len(train_dataloader)
-EPOCHS = 30
 
-# Scheduler
-scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer,
-                                                max_lr = MAX_LR,
-                                                steps_per_epoch = STEPS_PER_EPOCH,
-                                                epochs = EPOCHS,
-                                                pct_start = 1/10 if EPOCHS != 1 else 0.5,
-                                                div_factor = 10,
-                                                three_phase = True,
-                                                final_div_factor = 10,
-                                                anneal_strategy = "linear"
-                                                )
-
-## if the user has specified a model to preload before training , load it
-initial_epoch = 0
-global_step = 0
-# if config['preload']:
-#     model_filename = get_weights_file_path(config, config['preload'])
-#     print(f'Preloading model {model_filename}')
-#     state = torch.load(model_filename)
-#     model.load_state_dict(state['model_state_dict'])
-#     initial_epoch = state['epoch'] + 1
-#     optimizer.load_state_dict(state['optimizer_state_dict'])       ## important to store optimiser for Adam as all weights have different lr
-#     global_step = state['global_step']
-#     print("preloaded")
-
-loss_fn = nn.CrossEntropyLoss(ignore_index = tokenizer_src.token_to_id('[PAD]'), label_smoothing= 0.1)
-
-scaler = torch.cuda.amp.GradScaler()
-lr = [0.0]
-
-for epoch in range(initial_epoch, EPOCHS):
-    loss_acc = []
+import queue
+import threading
+
+## training telemetry: running aggregates that cost O(1) per step, and a TensorBoard writer that never blocks the step
+class TrainingMetrics:
+    PHASES = ("data", "forward", "backward", "optimizer")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = 0.0 # stays a tensor on the device of the loss, summing it does not wait for the device
+        self.batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.phase_time = dict.fromkeys(self.PHASES, 0.0)
+        self.start_time = time.perf_counter()
+
+    def update(self, loss, batch):
+        self.loss_sum = self.loss_sum + loss.detach()
+        self.batches += 1
+        ## the lengths are on the CPU (from the Collator), counting tokens does not touch the device
+        self.real_tokens += int(batch['encoder_length'].sum()) + int(batch['decoder_length'].sum())
+        self.padded_tokens += batch['encoder_input'].numel() + batch['decoder_input'].numel()
+
+    def add_time(self, phase:str, seconds:float):
+        self.phase_time[phase] += seconds
+
+    def mean_loss(self):
+        ## the only place that reads the loss back from the device
+        return float(self.loss_sum) / max(self.batches, 1)
+
+    def tokens_per_sec(self):
+        return self.real_tokens / max(time.perf_counter() - self.start_time, 1e-9)
+
+    def padding_ratio(self):
+        ## fraction of the [B, S] positions that are padding
+        return 1.0 - self.real_tokens / max(self.padded_tokens, 1)
+
+    def phase_fractions(self):
+        total = max(sum(self.phase_time.values()), 1e-9)
+        return {phase: t / total for phase, t in self.phase_time.items()}
+
+    def summary(self):
+        return {"loss": self.mean_loss(), "tokens_per_sec": self.tokens_per_sec(), "padding_ratio": self.padding_ratio(),
+                **{f"time_{phase}": t for phase, t in self.phase_time.items()}}
+
+
+class AsyncScalarWriter:
+    ## add_scalar only puts the value in a queue, a background thread writes to the SummaryWriter and flushes every flush_secs
+    ## values can be device tensors: they are read (and the device waited for) on the background thread
+    def __init__(self, writer, flush_secs:float = 10.0):
+        self.writer = writer
+        self.flush_secs = flush_secs
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def add_scalar(self, tag:str, value, global_step:int):
+        self.queue.put((tag, value, global_step))
+
+    def flush(self):
+        ## asks for a flush soon, does not wait for it
+        self.queue.put("flush")
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout = self.flush_secs)
+            except queue.Empty:
+                item = None
+            if item is not None and item != "flush" and item != "close":
+                tag, value, global_step = item
+                self.writer.add_scalar(tag, float(value), global_step)
+            if item in ("flush", "close") or time.monotonic() - last_flush >= self.flush_secs:
+                self.writer.flush()
+                last_flush = time.monotonic()
+            if item == "close":
+                return
+
+    def close(self):
+        ## writes everything still queued, then closes the SummaryWriter
+        self.queue.put("close")
+        self.thread.join()
+        self.writer.close()
+
+
+## the training loop, device agnostic:
+## precision "fp32" - no autocast
+##           "bf16" - bfloat16 autocast on the model's device (CPU or CUDA), no loss scaling needed
+##           "fp16" - float16 autocast with GradScaler, CUDA only
+## grad_accum_steps micro-batches are accumulated into one optimizer step, the OneCycleLR schedule counts optimizer steps
+class Trainer:
+    PRECISIONS = ("fp32", "bf16", "fp16")
+
+    def __init__(self, model, optimizer, scheduler, loss_fn, device, vocab_size:int, precision:str = "fp32", grad_accum_steps:int = 1, writer = None, show_progress:bool = True, log_every:int = 20):
+        assert precision in self.PRECISIONS, f"unknown precision {precision}"
+        if precision == "fp16" and device.type != 'cuda':
+            raise ValueError("fp16 needs loss scaling which is only available on CUDA, use bf16 on CPU")
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.loss_fn = loss_fn
+        self.device = device
+        self.vocab_size = vocab_size
+        self.precision = precision
+        self.grad_accum_steps = grad_accum_steps
+        self.writer = writer
+        self.show_progress = show_progress
+        self.log_every = log_every
+        self.autocast_dtype = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+        ## disabled scaler: scale() returns the loss, step() just calls optimizer.step() and the scale stays 1.0
+        self.scaler = torch.cuda.amp.GradScaler(enabled = precision == "fp16")
+        self.global_step = 0 # optimizer steps
+        self.lr_history = [0.0]
+
+    def state_dict(self):
+        ## everything needed to continue training exactly where it stopped (the model without a DDP wrapper)
+        return {
+            'model_state_dict': getattr(self.model, 'module', self.model).state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),  ## important to store optimiser for Adam as all weights have different lr
+            'scheduler_state_dict': self.scheduler.state_dict(),
+            'scaler_state_dict': self.scaler.state_dict(),
+            'global_step': self.global_step,
+        }
 
-    model.train()
-    batch_iterator = tqdm(train_dataloader, desc = f"Processing Epoch {epoch:02d}")
+    def load_state_dict(self, state):
+        getattr(self.model, 'module', self.model).load_state_dict(state['model_state_dict'])
+        self.optimizer.load_state_dict(state['optimizer_state_dict'])
+        ## older checkpoints only have the model, the optimizer and global_step
+        if 'scheduler_state_dict' in state:
+            self.scheduler.load_state_dict(state['scheduler_state_dict'])
+        if 'scaler_state_dict' in state and self.scaler.is_enabled():
+            self.scaler.load_state_dict(state['scaler_state_dict'])
+        self.global_step = state['global_step']
+
+    @staticmethod
+    def optimizer_steps_per_epoch(num_batches:int, grad_accum_steps:int = 1):
+        ## a last incomplete group of micro-batches still makes an optimizer step
+        return math.ceil(num_batches / grad_accum_steps)
+
+    def forward_loss(self, batch):
+        encoder_input = batch['encoder_input'].to(self.device) # [B, seq_len]
+        decoder_input = batch['decoder_input'].to(self.device) # [B, seq_len]
+        ## only the lengths go to the device, the masks are derived inside attention
+        encoder_length = batch['encoder_length'].to(self.device) # [B]
+        decoder_length = batch['decoder_length'].to(self.device) # [B]
+        label = batch['label'].to(self.device) ## [B, seq_len]
 
-    for batch in batch_iterator:
-        torch.cuda.empty_cache()
+        ## run the tensors through the encoder, decoder and projection layer
+        ## through model(...) and not encode/decode/project, so a DistributedDataParallel wrapper sees the forward pass
+        with torch.autocast(device_type = self.device.type, dtype = self.autocast_dtype, enabled = self.autocast_dtype is not None):
+            proj_output = self.model(encoder_input, decoder_input, encoder_length, decoder_length) # [B, seq_len, Vocab_size]
 
-        encoder_input = batch['encoder_input'].to(device) # [B, seq_len]
-        decoder_input = batch['decoder_input'].to(device) # [B, seq_len]
-        encoder_mask = batch['encoder_mask'].to(device) # [B, 1, 1, Seq_len]
-        decoder_mask = batch['decoder_mask'].to(device) # [B, 1, Seq_len, Seq_len]
+            ## compare the ouput with the label, compute the loss using simple cross entropy
+            return self.loss_fn(proj_output.view(-1, self.vocab_size), label.view(-1))
 
-        ## run the tensors through the encoder, decoder and projection layer
-        # print(encoder_input.shape)
-        # print(decoder_mask.shape)
-        encoder_mask = encoder_mask.unsqueeze(1)
-        decoder_mask = decoder_mask.unsqueeze(1)
-        # print(encoder_mask.shape)
+    def optimizer_step(self):
+        ## update the weights
+        scale = self.scaler.get_scale()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        ## the scale only goes down when the step was skipped for inf/nan gradients, the schedule must not advance then
+        skip_lr_sched = (scale > self.scaler.get_scale())
+        if not skip_lr_sched:
+            self.scheduler.step()
+        self.lr_history.append(self.scheduler.get_last_lr())
+        self.optimizer.zero_grad(set_to_none = True)
+        self.global_step += 1
+
+    def train_epoch(self, train_dataloader, epoch:int, start_batch:int = 0, on_step = None):
+        ## start_batch resumes in the middle of an epoch, on_step(epoch, batches_done) is called after every optimizer step
+
+        self.model.train()
+        ## reshuffle the length buckets of the token budget sampler / the DistributedSampler for this epoch
+        for sampler in (train_dataloader.sampler, train_dataloader.batch_sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+        num_batches = len(train_dataloader)
+        batches = train_dataloader
+        if start_batch and hasattr(train_dataloader.batch_sampler, 'start_batch'):
+            ## the token budget sampler is seeded per epoch, so it can skip straight to the same position
+            train_dataloader.batch_sampler.start_batch = start_batch
+        elif start_batch:
+            ## the DistributedSampler (get_train_dataloader) is seeded per epoch too, but its batches are loaded and dropped
+            batches = itertools.islice(train_dataloader, start_batch, None)
+        batch_iterator = tqdm(batches, desc = f"Processing Epoch {epoch:02d}", total = num_batches, initial = start_batch, disable = not self.show_progress)
+        metrics = self.metrics = TrainingMetrics()
+
+        ## phase timings are host time: on CUDA the kernels run asynchronously and most of their time lands where the host waits
+        t = time.perf_counter()
+        for micro_step, batch in enumerate(batch_iterator, start = start_batch):
+            metrics.add_time("data", time.perf_counter() - t)
+
+            last_micro_step = (micro_step + 1) % self.grad_accum_steps == 0 or micro_step + 1 == num_batches
+            ## the last group of an epoch can have fewer than grad_accum_steps micro-batches, average over the ones it has
+            group_start = micro_step - micro_step % self.grad_accum_steps
+            group_size = min(self.grad_accum_steps, num_batches - group_start)
+
+            ## with DistributedDataParallel the gradients are only all-reduced on the last micro-batch of the step,
+            ## no_sync covers the forward pass too (DistributedDataParallel sets up the reduction in forward)
+            with (self.model.no_sync() if hasattr(self.model, 'no_sync') and not last_micro_step else contextlib.nullcontext()):
+                t = time.perf_counter()
+                loss = self.forward_loss(batch)
+                metrics.update(loss, batch)
+                metrics.add_time("forward", time.perf_counter() - t)
+
+                ## log the loss, the value is read on the writer thread
+                if self.writer:
+                    self.writer.add_scalar('train_loss', loss.detach(), self.global_step)
+
+                ## backpropagate the loss, averaged over the micro-batches of one optimizer step
+                t = time.perf_counter()
+                self.scaler.scale(loss / group_size).backward()
+                metrics.add_time("backward", time.perf_counter() - t)
+
+            if last_micro_step:
+                t = time.perf_counter()
+                self.optimizer_step()
+                metrics.add_time("optimizer", time.perf_counter() - t)
+                if on_step:
+                    on_step(epoch, micro_step + 1)
+
+            ## the progress bar reads the loss back from the device only every log_every batches
+            if self.show_progress and metrics.batches % self.log_every == 0:
+                batch_iterator.set_postfix(
+                    {"loss_acc": f"{metrics.mean_loss():6.3f}", "tok/s": f"{metrics.tokens_per_sec():.0f}",
+                     "pad": f"{metrics.padding_ratio():.2f}", "lr" : f"{get_lr(self.optimizer)}"
+                    })
+            t = time.perf_counter()
+
+        if self.writer and metrics.batches:
+            for name, value in metrics.summary().items():
+                self.writer.add_scalar(f'train_epoch/{name}', value, self.global_step)
+            self.writer.flush()
+        return batch_iterator
+
+
+## checkpoints: the state is copied to CPU on the training thread and written to disk on a background thread
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+def snapshot_state(obj):
+    ## copy of a (nested) state dict with every tensor cloned to CPU, so training can keep updating the live tensors
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return {k: snapshot_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return obj
+
+
+def load_checkpoint(path, map_location = 'cpu'):
+    ## mmap: the tensors stay in the file and their pages are only read when a tensor is used
+    try:
+        return torch.load(path, map_location = map_location, mmap = True, weights_only = False)
+    except (TypeError, RuntimeError):
+        ## older torch, or a checkpoint written in the legacy (non zip) format
+        return torch.load(path, map_location = map_location)
+
+
+class CheckpointManager:
+    ## keeps the last keep_last checkpoints in config['model_folder'], listed oldest first in checkpoints.json
+    ## a checkpoint is written to <file>.tmp and renamed when complete, so a crash never leaves a truncated checkpoint
+    def __init__(self, config, keep_last:int = 2, background:bool = True):
+        self.config = config
+        self.keep_last = keep_last
+        self.index_path = Path(config['model_folder']) / "checkpoints.json"
+        self.executor = ThreadPoolExecutor(max_workers = 1) if background else None
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def checkpoints(self):
+        if not self.index_path.exists():
+            return []
+        with open(self.index_path) as f:
+            return [p for p in json.load(f) if Path(p).exists()]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def _write_index(self, checkpoints):
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoints, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _write(self, path, state):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        with self.lock:
+            checkpoints = [p for p in self.checkpoints() if p != path] + [path]
+            for old in checkpoints[:-self.keep_last]:
+                os.remove(old)
+            self._write_index(checkpoints[-self.keep_last:])
+
+    def save(self, tag:str, state):
+        path = str(get_weights_file_path(self.config, tag))
+        ## at most one write in flight, so only one snapshot is held in memory besides the live state
+        self.wait()
+        state = snapshot_state(state)
+        if self.executor is None:
+            self._write(path, state)
+        else:
+            self.pending = self.executor.submit(self._write, path, state)
+        return path
+
+    def wait(self):
+        ## blocks until the last save is on disk, and re-raises its error if the write failed
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def load_model_for_inference(config, path, vocab_src_len, vocab_tgt_len):
+    ## the model is built on the meta device (no memory, no init) and takes the mmap'ed tensors of the checkpoint as they are
+    state = load_checkpoint(path)
+    with torch.device('meta'):
+        model = get_model(config, vocab_src_len, vocab_tgt_len)
+    model.load_state_dict(state['model_state_dict'], assign = True)
+    return model.eval()
+
+## ckpt = CheckpointManager(cfg, keep_last = 3)
+## model = load_model_for_inference(cfg, ckpt.latest(), tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+
+
+## reproducible CPU benchmark suite on a synthetic tokenizer and synthetic sentence pairs, runs offline
+## run_benchmarks -> save_benchmark_results (JSON with the machine metadata) -> compare_benchmarks against a stored baseline
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import datetime
+
+BENCHMARK_BASE = {"batch_size": 8, "seq_len": 64, "d_model": 512, "h": 8}
+BENCHMARK_SWEEPS = {"batch_size": (1, 8, 32), "seq_len": (32, 64, 128), "d_model": (256, 512), "h": (4, 8)}
+
+def synthetic_tokenizer(vocab_size:int = 1000):
+    ## word level tokenizer over the words w0 ... w{vocab_size - 5} plus the special tokens, no training data needed
+    vocab = {token: i for i, token in enumerate(["[UNK]", "[PAD]", "[SOS]", "[EOS]"])}
+    for i in range(vocab_size - len(vocab)):
+        vocab[f"w{i}"] = len(vocab)
+    tokenizer = Tokenizer(WordLevel(vocab = vocab, unk_token = "[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    return tokenizer
 
-        with torch.autocast(device_type = 'cuda', dtype = torch.float16 ):
-            encoder_output = model.encode(encoder_input, encoder_mask)  # [B, seq_len, d_model]
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)
-            proj_output = model.project(decoder_output) # [B, seq_len, Vocab_size]
 
-            ## compare the ouput with the label
-            label = batch['label'].to(device) ## [B, seq_len]
+def synthetic_pairs(num_pairs:int, vocab_size:int = 1000, min_words:int = 4, max_words:int = 40, seed:int = 0):
+    ## same layout as the opus_books rows: {'translation': {'src': ..., 'tgt': ...}}
+    rng = random.Random(seed)
+    def sentence():
+        return " ".join(f"w{rng.randrange(vocab_size - 4)}" for _ in range(rng.randint(min_words, max_words)))
+    return [{"translation": {"src": sentence(), "tgt": sentence()}} for _ in range(num_pairs)]
 
-            ## compute the loss using simple cross entropy
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            loss_acc.append(loss)
-            batch_iterator.set_postfix(
-                {"loss_acc": f"{torch.mean(torch.stack(loss_acc)).item():6.3f}",
-                    "loss": f"{loss.item():6.3f}", "lr" : f"{get_lr(optimizer)}"
-                })
 
+def machine_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, timeout = 5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "time": datetime.datetime.now().isoformat(timespec = "seconds"),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "mkldnn": torch.backends.mkldnn.is_available(),
+        "git_commit": commit,
+    }
 
 
-        ## log the loss
-        writer.add_scalar('train_loss', loss.item(), global_step)
-        writer.flush()
+def time_call(fn, repeats:int = 10, warmup:int = 2):
+    ## median and min of repeats single calls in milliseconds, the median is what compare_benchmarks uses
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"ms": statistics.median(times), "min_ms": min(times), "repeats": repeats}
+
+
+def benchmark_points(sweeps = BENCHMARK_SWEEPS, base = BENCHMARK_BASE):
+    ## one parameter varied at a time around the base point, instead of the full cross product
+    points = [dict(base)]
+    for key, values in sweeps.items():
+        points += [dict(base, **{key: v}) for v in values if v != base[key]]
+    return points
+
+
+def synthetic_batch(batch_size:int, seq_len:int, vocab_size:int, generator):
+    ## a Collator batch of random tokens with random lengths in [seq_len / 2, seq_len]
+    lengths = torch.randint(seq_len // 2, seq_len + 1, (batch_size,), generator = generator)
+    lengths[0] = seq_len
+    tokens = torch.randint(4, vocab_size, (batch_size, seq_len), generator = generator)
+    return {"encoder_input": tokens, "decoder_input": tokens.roll(1, dims = 1), "label": tokens,
+            "encoder_length": lengths, "decoder_length": lengths}
+
+
+def run_benchmarks(points = None, vocab_size:int = 1000, repeats:int = 10, num_pairs:int = 512, seed:int = 0):
+    points = points or benchmark_points()
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    tokenizer = synthetic_tokenizer(vocab_size)
+    results = {}
+    def record(name, timing):
+        results[name] = timing
+        print(f"{name:<55} {timing['ms']:10.3f} ms")
+
+    models = {}
+    for p in points:
+        B, S, d_model, h = p["batch_size"], p["seq_len"], p["d_model"], p["h"]
+        tag = f"B{B}_S{S}_d{d_model}_h{h}"
+        dropout = nn.Dropout(0.0)
+
+        ## attention kernel alone
+        query, key, value = (torch.randn(B, h, S, d_model // h, generator = generator) for _ in range(3))
+        mask = causal_mask(S).unsqueeze(0)
+        with torch.no_grad():
+            record(f"attention/{tag}", time_call(lambda: MultiHeadAttentionBlock.attention(query, key, value, mask, dropout), repeats))
+
+        if (S, d_model, h) not in models:
+            models[(S, d_model, h)] = build_transformer(vocab_size, vocab_size, 2 * S, 2 * S, d_model = d_model, h = h)
+        model = models[(S, d_model, h)]
+        batch = synthetic_batch(B, S, vocab_size, generator)
+
+        model.eval()
+        with torch.no_grad():
+            record(f"encode/{tag}", time_call(lambda: model.encode(batch["encoder_input"], src_lengths = batch["encoder_length"]), repeats))
+            ## an untrained model rarely emits [EOS], so every decode runs the full S steps; one sentence as in run_validation
+            if B == BENCHMARK_BASE["batch_size"]:
+                source = batch["encoder_input"][:1]
+                record(f"greedy_decode/S{S}_d{d_model}_h{h}",
+                       time_call(lambda: greedy_decode(model, source, None, tokenizer, tokenizer, S, torch.device("cpu")), max(1, repeats // 5), warmup = 1))
+
+        ## one training step: forward, backward, Adam
+        train_copy = copy.deepcopy(model)
+        optimizer = torch.optim.Adam(train_copy.parameters(), lr = 1e-4, eps = 1e-9)
+        trainer = Trainer(train_copy, optimizer, LambdaLR(optimizer, lambda step: 1.0), nn.CrossEntropyLoss(ignore_index = 1),
+                          torch.device("cpu"), vocab_size, show_progress = False)
+        train_copy.train()
+        def train_step():
+            trainer.forward_loss(batch).backward()
+            trainer.optimizer_step()
+        record(f"train_step/{tag}", time_call(train_step, max(1, repeats // 2)))
+
+    ## data pipeline: per sample tokenization in BillingualDataset.__getitem__ and per batch collation
+    pairs = synthetic_pairs(num_pairs, vocab_size, seed = seed)
+    dataset = BillingualDataset(pairs, tokenizer, tokenizer, "src", "tgt", 64)
+    def getitem_all():
+        for i in range(len(dataset)):
+            dataset[i]
+    timing = time_call(getitem_all, max(1, repeats // 5), warmup = 1)
+    timing["us_per_sample"] = timing["ms"] * 1000 / len(dataset)
+    record("dataset_getitem/per_epoch", timing)
+
+    collate = Collator(tokenizer.token_to_id("[PAD]"), tokenizer.token_to_id("[PAD]"))
+    for batch_size in BENCHMARK_SWEEPS["batch_size"]:
+        samples = [dataset[i % len(dataset)] for i in range(batch_size)]
+        record(f"collate/Collator_B{batch_size}", time_call(lambda: collate(samples), repeats))
+        ## the legacy collate_fn reads the pad ids from the global tokenizer_src / tokenizer_tgt, only there after get_ds
+        if "tokenizer_src" in globals():
+            record(f"collate/collate_fn_B{batch_size}", time_call(lambda: collate_fn(samples), repeats))
+    return results
+
+
+def save_benchmark_results(results, path):
+    with open(path, "w") as f:
+        json.dump({"metadata": machine_metadata(), "results": results}, f, indent = 2)
+    return path
+
+
+def compare_benchmarks(current, baseline, threshold:float = 0.10):
+    ## current / baseline: paths of save_benchmark_results files (or their loaded dicts)
+    ## a benchmark regresses when its median is more than threshold slower than the baseline; returns the regressions
+    def load(results):
+        if isinstance(results, (str, Path)):
+            with open(results) as f:
+                results = json.load(f)
+        return results
+    current, baseline = load(current), load(baseline)
+    for key in ("processor", "cpu_count", "torch_threads", "torch"):
+        if current["metadata"].get(key) != baseline["metadata"].get(key):
+            print(f"warning: {key} differs ({baseline['metadata'].get(key)} -> {current['metadata'].get(key)}), timings may not be comparable")
+    regressions = {}
+    for name, timing in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = timing["ms"] / max(baseline["results"][name]["ms"], 1e-9)
+        flag = "REGRESSION" if ratio > 1 + threshold else ("faster" if ratio < 1 - threshold else "")
+        print(f"{name:<55} {baseline['results'][name]['ms']:10.3f} -> {timing['ms']:10.3f} ms  x{ratio:5.2f} {flag}")
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+# save_benchmark_results(run_benchmarks(), "benchmark.json")
+# compare_benchmarks("benchmark.json", "benchmark_baseline.json")
+
+
+## local asyncio HTTP/JSON translation server with dynamic micro-batching
+## requests are queued, a batch is closed when it reaches max_batch_tokens / max_batch_size or when its first request has
+## waited max_wait_ms, and it is decoded with batched_greedy_decode on a worker thread. Every request's future is resolved
+## as soon as its row emits [EOS], not when the whole batch is done.
+## POST /translate {"text": "..."} -> {"translation": "..."}        GET /stats -> latency percentiles and counters
+import asyncio
+from collections import deque
+
+def percentile(values, q:float):
+    ## nearest rank percentile, q in [0, 100]
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+class ServingStats:
+    ## counters since start plus the latencies of the last window requests
+    def __init__(self, window:int = 10000):
+        self.latencies = deque(maxlen = window) # seconds, arrival -> translation ready
+        self.requests = 0
+        self.batches = 0
+        self.batch_rows = 0
+        self.output_tokens = 0
+        self.start_time = time.perf_counter()
+
+    def record_batch(self, rows:int):
+        self.batches += 1
+        self.batch_rows += rows
+
+    def record_request(self, latency:float, output_tokens:int):
+        self.requests += 1
+        self.output_tokens += output_tokens
+        self.latencies.append(latency)
+
+    def summary(self):
+        uptime = time.perf_counter() - self.start_time
+        latencies = list(self.latencies)
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.batch_rows / max(self.batches, 1),
+            "requests_per_sec": self.requests / uptime,
+            "output_tokens_per_sec": self.output_tokens / uptime,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
 
-        ## backpropagate the loss
-        # loss.backward()
-        scaler.scale(loss).backward()
 
-        ## update the weights
-        # optimizer.step()
-        scale = scaler.get_scale()
-        scaler.step(optimizer)
-        scaler.update()
-        skip_lr_sched = (scale > scaler.get_scale())
-        if not skip_lr_sched:
-            scheduler.step()
-        lr.append(scheduler.get_last_lr())
-        optimizer.zero_grad(set_to_none = True)
+class TranslationServer:
+    def __init__(self, model, tokenizer_src, tokenizer_tgt, device, seq_len:int, max_batch_tokens:int = 4096,
+                 max_batch_size:int = 64, max_wait_ms:float = 5.0):
+        self.model = model.eval()
+        self.tokenizer_src = tokenizer_src
+        self.tokenizer_tgt = tokenizer_tgt
+        self.device = device
+        self.seq_len = seq_len
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.sos_idx = tokenizer_src.token_to_id('[SOS]')
+        self.eos_idx = tokenizer_src.token_to_id('[EOS]')
+        self.pad_idx = tokenizer_src.token_to_id('[PAD]')
+        ## one decode thread, the batcher keeps one batch on it and forms the next one on the event loop meanwhile
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.stats = ServingStats()
+        self.queue = None
+        self.server = None
+        self.carry = None # request that did not fit the token budget of the previous batch, starts the next one
+
+    async def translate(self, text:str):
+        ## tokenized on arrival, the batcher needs the length to keep a batch under max_batch_tokens
+        ids = self.tokenizer_src.encode(text).ids[: self.seq_len - 2]
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(([self.sos_idx] + ids + [self.eos_idx], future, time.perf_counter()))
+        return await future
+
+    async def next_request(self, deadline:float):
+        ## a request that is already queued is taken without waiting, otherwise wait for one until the deadline (None after it)
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        timeout = deadline - time.perf_counter()
+        if timeout <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def fill_batch(self, batch, deadline:float):
+        ## adds requests until max_batch_size, the token budget or the deadline is reached
+        max_len = max(len(ids) for ids, _, _ in batch)
+        while len(batch) < self.max_batch_size and self.carry is None:
+            item = await self.next_request(deadline)
+            if item is None:
+                break
+            ## padded size of the batch with this request in it
+            if max(max_len, len(item[0])) * (len(batch) + 1) > self.max_batch_tokens:
+                self.carry = item
+                break
+            batch.append(item)
+            max_len = max(max_len, len(item[0]))
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        ## at most one batch on the decode thread, released when it finishes; batch N + 1 is formed while batch N decodes
+        decoding = asyncio.Semaphore(1)
+
+        def batch_done(batch, future):
+            decoding.release()
+            if not future.cancelled() and future.exception() is not None:
+                for _, request_future, _ in batch:
+                    if not request_future.done():
+                        request_future.set_exception(future.exception())
+
+        while True:
+            batch = [self.carry or await self.queue.get()]
+            self.carry = None
+            await self.fill_batch(batch, batch[0][2] + self.max_wait)
+            ## the requests that arrived while the previous batch was decoding join without any further wait
+            await decoding.acquire()
+            await self.fill_batch(batch, 0)
+            self.stats.record_batch(len(batch))
+            future = loop.run_in_executor(self.executor, self.decode_batch, batch, loop)
+            future.add_done_callback(lambda future, batch = batch: batch_done(batch, future))
+
+    def decode_batch(self, batch, loop):
+        ## runs on the worker thread
+        source = pad_sequence([torch.tensor(ids, dtype = torch.int64) for ids, _, _ in batch], batch_first = True, padding_value = self.pad_idx).to(self.device)
+        source_lengths = torch.tensor([len(ids) for ids, _, _ in batch], dtype = torch.int64, device = self.device)
+
+        def on_finished(row, ids):
+            ids = strip_padding(ids.tolist(), self.tokenizer_tgt)
+            _, future, arrival = batch[row]
+            self.stats.record_request(time.perf_counter() - arrival, len(ids))
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(self.tokenizer_tgt.decode(ids)))
+
+        with torch.no_grad():
+            batched_greedy_decode(self.model, source, None, self.tokenizer_tgt, self.seq_len, self.device,
+                                  source_lengths = source_lengths, on_finished = on_finished)
+
+    async def handle_connection(self, reader, writer):
+        ## minimal HTTP/1.1: one request per connection, JSON in and out
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            method, path = request_line[0], request_line[1]
+            if method == "POST" and path == "/translate":
+                status, response = 200, {"translation": await self.translate(json.loads(body)["text"])}
+            elif method == "GET" and path == "/stats":
+                status, response = 200, self.stats.summary()
+            else:
+                status, response = 404, {"error": f"no route {method} {path}"}
+        except Exception as e:
+            status, response = 400, {"error": str(e)}
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def start(self, host:str = "127.0.0.1", port:int = 8000):
+        self.queue = asyncio.Queue()
+        self.batcher_task = asyncio.create_task(self.batcher())
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+
+    def serve_forever(self, host:str = "127.0.0.1", port:int = 8000):
+        async def main():
+            port_ = await self.start(host, port)
+            print(f"serving on http://{host}:{port_}")
+            await self.server.serve_forever()
+        asyncio.run(main())
+
+
+async def http_json(host:str, port:int, method:str, path:str, data = None):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(data).encode() if data is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def load_test(host:str, port:int, sentences, num_requests:int = 200, concurrency:int = 32):
+    ## concurrency clients sending requests back to back, client side latency percentiles and throughput
+    latencies = []
+    counter = itertools.count()
+    async def client():
+        while (i := next(counter)) < num_requests:
+            start = time.perf_counter()
+            await http_json(host, port, "POST", "/translate", {"text": sentences[i % len(sentences)]})
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests_per_sec": num_requests / elapsed, "p50_ms": percentile(latencies, 50) * 1000, "p99_ms": percentile(latencies, 99) * 1000,
+            "server": await http_json(host, port, "GET", "/stats")}
+
+
+def benchmark_serving(model, tokenizer_src, tokenizer_tgt, device, seq_len, sentences, settings = ((0, 1), (2, 1024), (5, 4096), (20, 8192)),
+                      num_requests:int = 200, concurrency:int = 32):
+    ## latency / throughput tradeoff: one in-process server per (max_wait_ms, max_batch_tokens) setting under the same load
+    ## (0, 1) closes every batch after one request, the same as calling greedy_decode per request
+    results = {}
+    for max_wait_ms, max_batch_tokens in settings:
+        server = TranslationServer(model, tokenizer_src, tokenizer_tgt, device, seq_len, max_batch_tokens, max_wait_ms = max_wait_ms)
+        async def run():
+            port = await server.start(port = 0)
+            try:
+                return await load_test("127.0.0.1", port, sentences, num_requests, concurrency)
+            finally:
+                await server.stop()
+        results[(max_wait_ms, max_batch_tokens)] = r = asyncio.run(run())
+        print(f"max_wait {max_wait_ms:5.1f} ms, max_batch_tokens {max_batch_tokens:6d} : {r['requests_per_sec']:8.1f} req/s, "
+              f"p50 {r['p50_ms']:8.1f} ms, p99 {r['p99_ms']:8.1f} ms, mean batch {r['server']['mean_batch_size']:5.1f}")
+    return results
+
+# TranslationServer(model, tokenizer_src, tokenizer_tgt, device, cfg['seq_len']).serve_forever(port = 8000)
+# benchmark_serving(model, tokenizer_src, tokenizer_tgt, device, cfg['seq_len'], [val_dataloader.dataset[i]['src_text'] for i in range(len(val_dataloader.dataset))])
 
-        global_step += 1
 
+# from config import get_config
 
-    ## run validation at the end of every epoch
-    run_validation(model,val_dataloader, tokenizer_src, tokenizer_tgt, cfg['seq_len'], device, lambda msg : batch_iterator.write(msg) , global_step, writer)
+cfg = get_config()
+cfg['batch_size'] = 8
+cfg['preload'] = None
+cfg['num_epochs'] = 10
 
-    ## remove the prev model files
-    if epoch > 0:
-        prev_model_filename  = get_weights_file_path(cfg, f"{epoch - 1:02d}")
-        os.remove(prev_model_filename)
+# from train import train_model
 
-    model_filename = get_weights_file_path(cfg, f"{epoch:02d}")
-    torch.save({
-        'epoch': epoch,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'global_step': global_step
-    }, model_filename )
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 
-source_lang = "en"
-target_lang = "hi"
+MAX_LR = 10**-3
+EPOCHS = 30
 
+def train_model(config, rank = 0, world_size = 1):
+    ## single process training, or one worker of a data parallel run over world_size CPU processes (gloo backend)
+    ## in a distributed run every rank trains on its own shard of the training batches, DistributedDataParallel averages
+    ## the gradients, and only rank 0 writes TensorBoard logs, runs the validation and saves checkpoints
+    ## the model init and dropout follow config['seed'], the split and the shuffling have their own generators seeded from it
+    torch.manual_seed(config.get('seed', 0))
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group("gloo", rank = rank, world_size = world_size)
+        config = dict(config, rank = rank, world_size = world_size)
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("Using device: ", device, f"(rank {rank} of {world_size})" if distributed else "")
+
+    ## make sure the weights folder exists
+    Path(config['model_folder']).mkdir(parents = True, exist_ok = True)
+
+    ## rank 0 builds the tokenizers (and the token cache) first, the other ranks wait and then read the files
+    if distributed and rank != 0:
+        dist.barrier()
+    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    if distributed and rank == 0:
+        dist.barrier()
+
+    ## config['shortlist'] validates with a vocabulary shortlist built from the training rows (token cache path only)
+    shortlist = None
+    if config.get('shortlist') and rank == 0 and isinstance(train_dataloader.dataset, TokenizedBillingualDataset):
+        train_ds = train_dataloader.dataset
+        shortlist = get_or_build_shortlist(train_ds.token_cache, train_ds.rows, tokenizer_src.get_vocab_size(), tokenizer_tgt,
+                                           config.get('shortlist_top_n', 50), config.get('shortlist_num_frequent', 1000))
+
+    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    raw_model = model
+    if distributed:
+        model = DistributedDataParallel(model)
+
+    # tensorboard
+    ## written on a background thread, flushed every config['log_flush_secs'] seconds
+    writer = AsyncScalarWriter(SummaryWriter(config['experiment_name']), config.get('log_flush_secs', 10)) if rank == 0 else None
+
+    optimizer = torch.optim.Adam(model.parameters(), lr = config['lr'] , eps = 1e-9)
+    ## each feature can have different learnign rate, so for words seen less it can increase learning rate of those weights
+
+    ## fp32, bf16 (CPU or CUDA) or fp16 with loss scaling (CUDA only)
+    precision = config.get('precision', 'fp16' if device.type == 'cuda' else 'fp32')
+    grad_accum_steps = config.get('grad_accum_steps', 1)
+    steps_per_epoch = Trainer.optimizer_steps_per_epoch(len(train_dataloader), grad_accum_steps)
+
+    # Scheduler
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer,
+                                                    max_lr = MAX_LR,
+                                                    steps_per_epoch = steps_per_epoch,
+                                                    epochs = EPOCHS,
+                                                    pct_start = 1/10 if EPOCHS != 1 else 0.5,
+                                                    div_factor = 10,
+                                                    three_phase = True,
+                                                    final_div_factor = 10,
+                                                    anneal_strategy = "linear"
+                                                    )
+
+    loss_fn = nn.CrossEntropyLoss(ignore_index = tokenizer_src.token_to_id('[PAD]'), label_smoothing= 0.1)
+
+    trainer = Trainer(model, optimizer, scheduler, loss_fn, device, tokenizer_tgt.get_vocab_size(), precision, grad_accum_steps, writer, show_progress = rank == 0,
+                      log_every = config.get('log_every', 20))
+    checkpoints = CheckpointManager(config, keep_last = config.get('keep_checkpoints', 2)) if rank == 0 else None
+
+    ## if the user has specified a model to preload before training , load it ('latest' = last checkpoint in the model folder)
+    ## every rank loads the same file, so the replicas start identical
+    initial_epoch, start_batch = 0, 0
+    if config['preload']:
+        model_filename = CheckpointManager(config, background = False).latest() if config['preload'] == 'latest' else get_weights_file_path(config, config['preload'])
+        print(f'Preloading model {model_filename}')
+        state = load_checkpoint(model_filename)
+        trainer.load_state_dict(state)
+        ## sampler position: (epoch, batches done in it), an end of epoch checkpoint resumes at the next epoch
+        initial_epoch, start_batch = state.get('sampler_position', (state['epoch'] + 1, 0))
+        del state
+        print("preloaded")
+
+    def save_checkpoint(epoch, batches_done, tag):
+        state = trainer.state_dict()
+        state['epoch'] = epoch
+        done = batches_done == len(train_dataloader)
+        state['sampler_position'] = (epoch + 1, 0) if done else (epoch, batches_done)
+        checkpoints.save(tag, state)
+
+    ## config['save_every_steps'] also saves in the middle of an epoch
+    save_every_steps = config.get('save_every_steps')
+    def on_step(epoch, batches_done):
+        if checkpoints and save_every_steps and trainer.global_step % save_every_steps == 0 and batches_done < len(train_dataloader):
+            save_checkpoint(epoch, batches_done, f"{epoch:02d}-{trainer.global_step:07d}")
+
+    for epoch in range(initial_epoch, EPOCHS):
+        batch_iterator = trainer.train_epoch(train_dataloader, epoch, start_batch, on_step)
+        start_batch = 0
+        global_step = trainer.global_step
+
+        if rank != 0:
+            continue
+
+        ## the checkpoint is written while the validation runs
+        save_checkpoint(epoch, len(train_dataloader), f"{epoch:02d}")
+
+        ## run validation at the end of every epoch
+        run_validation(raw_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg : batch_iterator.write(msg) , global_step, writer,
+                       shortlist = shortlist)
+
+    if checkpoints:
+        checkpoints.close()
+    if writer:
+        writer.close()
+    if distributed:
+        dist.destroy_process_group()
+    return raw_model, tokenizer_src, tokenizer_tgt, device
+
+
+def train_worker(rank, world_size, config):
+    ## entry point of one worker process, the cores of the machine are split between the workers
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    train_model(config, rank, world_size)
+
+
+def launch_distributed(config, world_size:int, master_addr:str = "127.0.0.1", master_port:str = "29500"):
+    ## starts world_size worker processes on this machine. "fork" so that the workers do not re-run this script
+    os.environ.setdefault("MASTER_ADDR", master_addr)
+    os.environ.setdefault("MASTER_PORT", master_port)
+    mp.start_processes(train_worker, args = (world_size, config), nprocs = world_size, start_method = "fork")
+
+
+def train_from_env(config):
+    ## for several machines: start one process per worker with torchrun (or set RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT)
+    ## the model folder and tokenizer files must be on a filesystem shared by all machines
+    world_size = int(os.environ["WORLD_SIZE"])
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return train_model(config, int(os.environ["RANK"]), world_size)
+
+
+## world_size > 1 trains with that many processes on this machine
+WORLD_SIZE = cfg.get('world_size', 1)
+if WORLD_SIZE > 1:
+    launch_distributed(cfg, WORLD_SIZE)
+    ## the workers are gone, reload the tokenizers and the last checkpoint written by rank 0
+    device = torch.device("cpu")
+    tokenizer_src = get_or_build_tokenizer(cfg, None, cfg['lang_src'])
+    tokenizer_tgt = get_or_build_tokenizer(cfg, None, cfg['lang_tgt'])
+    model = load_model_for_inference(cfg, CheckpointManager(cfg, background = False).latest(), tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+else:
+    model, tokenizer_src, tokenizer_tgt, device = train_model(cfg)
+
+## translate a sentence with the trained model
 input_text = "My name is Ramnarayan and I am a data scientist in google "
 
-# Tokenize input text
-tokenized = tokenizer([input_text], return_tensors='np')
+model.eval()
+with torch.no_grad():
+    # tokenize the input text, same [SOS] ... [EOS] layout as BillingualDataset
+    source = torch.tensor([[tokenizer_tgt.token_to_id('[SOS]')] + tokenizer_src.encode(input_text).ids + [tokenizer_tgt.token_to_id('[EOS]')]], dtype = torch.int64).to(device)
+    source_lengths = torch.tensor([source.size(1)], device = device)
+
+    # generate translation
+    out, _ = beam_search_decode(model, source, None, tokenizer_tgt, cfg['seq_len'], device, source_lengths = source_lengths)
 
-# Generate translation
-out = model.generate(**tokenized, max_length=128)
-print(out)
+# decode generated output
+print(tokenizer_tgt.decode(strip_padding(out[0].tolist(), tokenizer_tgt)))
 
-# Decode generated output
-with tokenizer.as_target_tokenizer():
-    print(tokenizer.decode(out[0], skip_special_tokens=True))
\ No newline at end of file
+## export the encoder and the decoder step for serving
+# export_inference_graphs(model, Path(cfg['model_folder']) / "export", tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+# check_export_parity(model, Path(cfg['model_folder']) / "export", tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())